@@ -6,10 +6,18 @@
 """
 
 import cPickle as pickle
+import collections
+import itertools
+import json
+import math
 import os
+import random
 import threading
 import time
 import types
+import uuid
+import zlib
+from multiprocessing.pool import ThreadPool
 
 import redis
 
@@ -31,6 +39,8 @@ def listReplace(inString, listOfItems, replacement):
 REDIS_NUM_DBS = int(os.environ.get("REDIS_NUM_DBS", "1"))
 
 class Redis(redis.Redis):
+    codec = None # The Codec items using this client encode values with (DEFAULT_CODEC if None)
+
     def reconnect(self):
         ''' Reconnect to redis '''
         self.connection.disconnect()
@@ -48,33 +58,325 @@ LONG_CACHE_TIME = 60 * 60 * 24 * 7
 SHORT_CACHE_TIME = 60 * 60 * 8
 VERY_SHORT_CACHE_TIME = 60 * 5
 FOREVER_CACHE_TIME = 0 # If you use this, make sure you have a way to clear them yourself!
+LOCAL_CACHE_SIZE = int(os.environ.get("REDIS_LOCAL_CACHE_SIZE", "0")) # 0 disables the in process cache
+# Most seconds a value is served from the in process cache, so keys deleted or flushed in redis drop out of it soon
+LOCAL_CACHE_TTL = int(os.environ.get("REDIS_LOCAL_CACHE_TTL", "60"))
+SINGLE_FLIGHT_TIMEOUT = 10 # Seconds a caller may hold the right to compute a missing cache value
+SINGLE_FLIGHT_POLL_INTERVAL = .05 # Seconds between checks while waiting on another caller's result
+BACKGROUND_THREADS = int(os.environ.get("REDIS_BACKGROUND_THREADS", "4")) # Threads used for background refreshes
+NEAR_CACHE_MAX_STALENESS = float(os.environ.get("REDIS_NEAR_CACHE_MAX_STALENESS", "5")) # Seconds a mirror is trusted
+NEAR_CACHE_RETRY_INTERVAL = 1 # Seconds between attempts to resubscribe after a near cache subscription drops
+
+RELEASE_TOKEN_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+class LocalCache(object):
+    """ A size bounded, thread safe, in process LRU cache that sits in front of redis:
+           maxSize - the maximum number of entries to keep before evicting the least recently used
+           ttl - seconds an entry is served for before it is considered expired (0 means never)
+    """
+
+    def __init__(self, maxSize, ttl=0):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__entries__ = collections.OrderedDict()
+        self.__lock__ = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.__lock__:
+            entry = self.__entries__.pop(key, None)
+            if entry is None or (entry[1] and entry[1] <= time.time()):
+                self.misses += 1
+                return default
+            self.__entries__[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        expiresAt = self.ttl and time.time() + self.ttl or 0
+        with self.__lock__:
+            self.__entries__.pop(key, None)
+            self.__entries__[key] = (value, expiresAt)
+            while len(self.__entries__) > self.maxSize:
+                self.__entries__.popitem(last=False)
+
+    def delete(self, key):
+        with self.__lock__:
+            return self.__entries__.pop(key, None) is not None
+
+    def clear(self):
+        with self.__lock__:
+            self.__entries__.clear()
+
+    def stats(self):
+        """ Returns the hit/miss counters for sizing the cache """
+        return {'hits':self.hits, 'misses':self.misses, 'size':len(self.__entries__), 'maxSize':self.maxSize}
+
+    def __len__(self):
+        return len(self.__entries__)
+
+def backgroundPool():
+    """ Returns the shared thread pool used for background work (created on first use) """
+    global _backgroundPool
+    if _backgroundPool is None:
+        with _backgroundPoolLock:
+            if _backgroundPool is None:
+                _backgroundPool = ThreadPool(BACKGROUND_THREADS)
+    return _backgroundPool
+_backgroundPool = None
+_backgroundPoolLock = threading.Lock()
+
+def cache(func, rstoreType, cacheTime=LONG_CACHE_TIME, dontCreateIfReturnedIn=[], localCacheSize=None,
+          singleFlight=False, singleFlightTimeout=SINGLE_FLIGHT_TIMEOUT, staleTime=0, earlyRefreshBeta=1.0):
+    """ Wraps func so its results are stored in redis as rstoreType for cacheTime seconds:
+           localCacheSize - if set (defaults to LOCAL_CACHE_SIZE) results are also kept in an in process LRU
+                            cache of that size, so hot values only go to redis on a local miss.
+                            Values served from it are shared between callers - don't mutate them - and are
+                            kept at most LOCAL_CACHE_TTL seconds, so deleting the redis key reaches it.
+           singleFlight - on a miss only one caller (across all processes) computes the value, the rest wait
+                          up to singleFlightTimeout seconds for it before falling back to computing it themselves.
+           staleTime - if set, values are kept staleTime seconds past cacheTime and served stale while a
+                       background thread recomputes them. Callers start refreshing early with a probability
+                       that grows as expiry nears and with how long the value took to compute
+                       (scaled by earlyRefreshBeta), so refreshes for a key are spread out instead of
+                       all landing at the moment it expires.
+    """
+    if localCacheSize is None:
+        localCacheSize = LOCAL_CACHE_SIZE
+    localCache = None
+    if localCacheSize:
+        localCache = LocalCache(localCacheSize, min(cacheTime or LOCAL_CACHE_TTL, LOCAL_CACHE_TTL))
+    staleWhileRevalidate = bool(staleTime and cacheTime)
+    refreshing = set()
+    refreshingLock = threading.Lock()
 
-def cache(func, rstoreType, cacheTime=LONG_CACHE_TIME, dontCreateIfReturnedIn=[]):
     def _cache(* args, **kw):
-        startPos = 1
-        if func.func_code.co_varnames and func.func_code.co_varnames[0] != 'self':
-            startPos = 0
-        keyargs = ",".join([str(arg) for arg in args[startPos:]] + \
-                [str(kw.get(func.func_code.co_varnames[i], getDefault(i, func))) for i in range(len(args), func.func_code.co_argcount)])
-        key = "%s.%s(%s)" % (func.__module__, func.func_name, keyargs)
+        key = cacheKey(args, kw)
+
+        if localCache is not None:
+            storeValue = localCache.get(key)
+            if storeValue is not None:
+                return storeValue
 
-        rstore = rstoreType(key, create=False)
         try:
-            storeValue = rstore.value()
+            storeValue, refreshInfo = readValue(key)
             if storeValue != None:
-                if cacheTime:
-                    rstore.expire(cacheTime)
+                if staleWhileRevalidate and shouldRefresh(refreshInfo):
+                    scheduleRefresh(key, args, kw)
+                if localCache is not None:
+                    localCache.set(key, storeValue)
                 return storeValue
         except:
             pass
 
+        rstore = rstoreType(key, create=False)
+        computeToken = None
+        if singleFlight:
+            computeToken = takeComputeToken(rstore)
+            if not computeToken:
+                storeValue = waitForValue(rstore)
+                if storeValue != None:
+                    if localCache is not None:
+                        localCache.set(key, storeValue)
+                    return storeValue
+
+        try:
+            return computeAndStore(rstore, key, args, kw)
+        finally:
+            if computeToken:
+                releaseComputeToken(rstore, computeToken)
+
+    def readValue(key):
+        """ Reads a cached value along with its refresh info, refreshing its TTL in the same round trip:
+            the stored format is checked by decoding so no separate TYPE lookup is needed
+        """
+        if not rstoreType.readCommand:
+            rstore = rstoreType(key, create=False)
+            storeValue = rstore.value()
+            refreshInfo = None
+            if storeValue != None and staleWhileRevalidate:
+                refreshInfo = rstore.rclient.get(rstore.key + ".refresh")
+            elif storeValue != None and cacheTime:
+                rstore.expire(cacheTime)
+            return storeValue, refreshInfo
+
+        rkey = rstoreType.inKey(key)
+        pipe = redisClient.pipeline(transaction=False)
+        pipe.execute_command(rstoreType.readCommand[0], rkey, *rstoreType.readCommand[1:])
+        if staleWhileRevalidate:
+            pipe.get(rkey + ".refresh")
+        elif cacheTime:
+            pipe.expire(rkey, cacheTime)
+        replies = pipe.execute()
+        refreshInfo = staleWhileRevalidate and replies[1] or None
+        return rstoreType.__fromRedis__(replies[0]), refreshInfo
+
+    def computeAndStore(rstore, key, args, kw):
+        startedAt = time.time()
         res = func(*args, **kw)
         if res != None and res not in dontCreateIfReturnedIn:
             rstore.resetValue(res)
-            if cacheTime:
+            if staleWhileRevalidate:
+                computeTime = time.time() - startedAt
+                rstore.expire(cacheTime + staleTime)
+                rstore.rclient.set(rstore.key + ".refresh", "%f,%f" % (computeTime, time.time() + cacheTime),
+                                   ex=cacheTime + staleTime)
+            elif cacheTime:
                 rstore.expire(cacheTime)
+            if localCache is not None:
+                localCache.set(key, res)
         return res
 
+    def shouldRefresh(refreshInfo):
+        """ Decides if a value that is still being served should be recomputed now (probabilistic early expiration) """
+        if not refreshInfo:
+            return True
+        computeTime, softExpiry = [float(part) for part in refreshInfo.split(",")]
+        return time.time() - computeTime * earlyRefreshBeta * math.log(1.0 - random.random()) >= softExpiry
+
+    def scheduleRefresh(key, args, kw):
+        with refreshingLock:
+            if key in refreshing:
+                return
+            refreshing.add(key)
+        backgroundPool().apply_async(refresh, (key, args, kw))
+
+    def refresh(key, args, kw):
+        try:
+            rstore = rstoreType(key, create=False)
+            computeToken = takeComputeToken(rstore)
+            if computeToken:
+                try:
+                    computeAndStore(rstore, key, args, kw)
+                finally:
+                    releaseComputeToken(rstore, computeToken)
+        except:
+            pass # The stale value stays in place and the next caller will retry
+        finally:
+            with refreshingLock:
+                refreshing.discard(key)
+
+    def takeComputeToken(rstore):
+        computeToken = uuid.uuid4().hex
+        if rstore.rclient.set(rstore.key + ".computing", computeToken, nx=True, ex=singleFlightTimeout):
+            return computeToken
+        return None
+
+    def releaseComputeToken(rstore, computeToken):
+        rstore.rclient.eval(RELEASE_TOKEN_SCRIPT, 1, rstore.key + ".computing", computeToken)
+
+    def waitForValue(rstore):
+        """ Waits for whoever holds the compute token to store the value, giving up if they release it without
+            storing one or singleFlightTimeout passes
+        """
+        giveUpAt = time.time() + singleFlightTimeout
+        while time.time() < giveUpAt:
+            time.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+            try:
+                storeValue = readValue(rstore.key)[0]
+                if storeValue != None:
+                    return storeValue
+            except:
+                pass
+            if not rstore.rclient.exists(rstore.key + ".computing"):
+                break
+
+        return None
+
+    def many(argsList, bulkFunc=None):
+        """ Returns the results for a list of argument tuples (include self first when wrapping a method):
+            every key is read in a single round trip, only the misses are computed - by calling
+            bulkFunc(listOfMissingArgs) if given, which must return results in the same order - and
+            they are written back together in one more round trip
+        """
+        argsList = [args if isinstance(args, tuple) else (args, ) for args in argsList]
+        keys = [cacheKey(args, {}) for args in argsList]
+        results = [None] * len(keys)
+
+        missing = []
+        for index, key in enumerate(keys):
+            if localCache is not None:
+                results[index] = localCache.get(key)
+            if results[index] is None:
+                missing.append(index)
+        if not missing:
+            return results
+
+        if rstoreType.readCommand:
+            pipe = redisClient.pipeline(transaction=False)
+            for index in missing:
+                rkey = rstoreType.inKey(keys[index])
+                pipe.execute_command(rstoreType.readCommand[0], rkey, *rstoreType.readCommand[1:])
+                if cacheTime and not staleWhileRevalidate:
+                    pipe.expire(rkey, cacheTime)
+            replies = pipe.execute(raise_on_error=False)
+            if cacheTime and not staleWhileRevalidate:
+                replies = replies[::2]
+        else:
+            replies = [rstoreType(keys[index], create=False).value() for index in missing]
+
+        stillMissing = []
+        for index, reply in zip(missing, replies):
+            try:
+                if isinstance(reply, Exception):
+                    raise reply
+                if rstoreType.readCommand:
+                    reply = rstoreType.__fromRedis__(reply)
+            except:
+                reply = None
+            if reply is None:
+                stillMissing.append(index)
+            else:
+                results[index] = reply
+                if localCache is not None:
+                    localCache.set(keys[index], reply)
+        if not stillMissing:
+            return results
+
+        startedAt = time.time()
+        if bulkFunc:
+            computed = list(bulkFunc([argsList[index] for index in stillMissing]))
+            if len(computed) != len(stillMissing):
+                raise ValueError("bulkFunc returned %d results for %d arguments" % (len(computed), len(stillMissing)))
+        else:
+            computed = [func(*argsList[index]) for index in stillMissing]
+        computeTime = (time.time() - startedAt) / len(stillMissing)
+
+        pipe = redisClient.pipeline(transaction=False)
+        for index, res in zip(stillMissing, computed):
+            results[index] = res
+            if res == None or res in dontCreateIfReturnedIn:
+                continue
+            rkey = rstoreType.inKey(keys[index])
+            if rstoreType.readCommand:
+                rstoreType.__writeValue__(pipe, rkey, res)
+            else:
+                rstoreType(rkey, create=False).resetValue(res)
+            if staleWhileRevalidate:
+                pipe.expire(rkey, cacheTime + staleTime)
+                pipe.set(rkey + ".refresh", "%f,%f" % (computeTime, time.time() + cacheTime), ex=cacheTime + staleTime)
+            elif cacheTime:
+                pipe.expire(rkey, cacheTime)
+            if localCache is not None:
+                localCache.set(keys[index], res)
+        pipe.execute()
+
+        return results
+
+    def cacheKey(args, kw):
+        startPos = 1
+        if func.func_code.co_varnames and func.func_code.co_varnames[0] != 'self':
+            startPos = 0
+        keyargs = ",".join([str(arg) for arg in args[startPos:]] + \
+                [str(kw.get(func.func_code.co_varnames[i], getDefault(i, func))) for i in range(len(args), func.func_code.co_argcount)])
+        return "%s.%s(%s)" % (func.__module__, func.func_name, keyargs)
+
     def getDefault(i, func):
         if not func.func_defaults:
             return ""
@@ -83,6 +385,8 @@ def cache(func, rstoreType, cacheTime=LONG_CACHE_TIME, dontCreateIfReturnedIn=[]
             return func.func_defaults[index]
         return ""
 
+    _cache.localCache = localCache
+    _cache.many = many
     return _cache
 
 def cacheString(func):
@@ -194,35 +498,336 @@ dbNum = 0
 class RegularRedis(Redis):
     def __init__(self, host='localhost', port=6379,
                     db=0, password=None, socket_timeout=None, connection_pool=None,
-                    charset='utf-8', errors='strict', useATDB=False):
+                    charset='utf-8', errors='strict', useATDB=False, codec=None):
         super(RegularRedis, self).__init__(host, port, db, password, socket_timeout, connection_pool, charset, errors)
+        self.codec = codec
 Redis = RegularRedis
 redis.Redis = RegularRedis
 redisClient = Redis(os.environ.get("REDIS_HOST", "localhost"))
 
 KEY_REPLACEMENTS = ([" ", "(", ")", "[", "]"], ["%20", "%28", "%29", "%5b", "%5d"])
 
-class RedisItem(threading.local):
-    """The base redis item type"""
+class Codec(object):
+    """ Turns python values into strings for storing in redis and back:
+           tag - the single character stored in front of encoded values so they can be decoded later
+    """
+    tag = None
+
+    def encode(self, value):
+        """ Returns value as a string - codecs must implement this """
+        pass
+
+    def decode(self, data):
+        """ Returns the value data was encoded from - codecs must implement this """
+        pass
+
+
+class PickleCodec(Codec):
+    """ Stores any picklable python object using the fastest, most compact, pickle protocol """
+    tag = "p"
+
+    def encode(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+
+class JSONCodec(Codec):
+    """ Stores values as JSON so they can be read by non python clients """
+    tag = "j"
+
+    def encode(self, value):
+        return json.dumps(value, separators=(',', ':'))
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class BytesCodec(Codec):
+    """ Stores strings as is - used to keep strings that happen to look encoded from being decoded """
+    tag = "b"
+
+    def encode(self, value):
+        if type(value) == types.UnicodeType:
+            return value.encode('utf-8')
+        if type(value) != types.StringType:
+            raise TypeError("BytesCodec can only store strings not %s" % type(value))
+        return value
+
+    def decode(self, data):
+        return data
+
+
+class LegacyPickleCodec(Codec):
+    """ Writes the old text pickle format ("<pckl:>"/"<vpckl:>") for keys shared with older readers, or sets and
+        lists whose existing members need to keep comparing equal - it's never compressed
+    """
+
+    def encode(self, value):
+        return pickle.dumps(value)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+CODECS = {}
+def registerCodec(codec):
+    """ Makes a codec available for decoding (and encoding) values by its tag """
+    if not codec.tag or len(codec.tag) != 1:
+        raise ValueError("Codec tags must be a single character")
+    CODECS[codec.tag] = codec
+    return codec
+
+PICKLE_CODEC = registerCodec(PickleCodec())
+JSON_CODEC = registerCodec(JSONCodec())
+BYTES_CODEC = registerCodec(BytesCodec())
+LEGACY_PICKLE_CODEC = LegacyPickleCodec()
+DEFAULT_CODEC = PICKLE_CODEC # Used when neither the item nor its redis client specify one
+
+# Encoded values are ENCODED_PREFIX, a marker byte, the codec tag, and the codec's output - the prefix is long and
+# improbable enough that raw strings already stored in lists, sets and hashes aren't mistaken for encoded values
+ENCODED_PREFIX = "\x00RS"
+VALUE_MARKER = "\x00"
+COMPRESSED_VALUE_MARKER = "\x01"
+DICT_MARKER = "\x02" # RedisPickledDict values - kept apart so RedisKeyDict can tell them from RedisObjects
+COMPRESSED_DICT_MARKER = "\x03"
+ENCODED_HEADER_LENGTH = len(ENCODED_PREFIX) + 2
+LEGACY_PICKLE_PREFIX = "<pckl:>"
+LEGACY_VPICKLE_PREFIX = "<vpckl:>"
+
+# Encoded values of at least this many bytes are stored zlib compressed (0 disables compression). Keep it the same
+# across writers of a set or list, as the same object compressed and uncompressed are different members.
+COMPRESSION_THRESHOLD = int(os.environ.get("REDIS_COMPRESSION_THRESHOLD", "0"))
+compressionStats = {'compressed':0, 'bytesBefore':0, 'bytesSaved':0}
+
+def compressPickle(pickled):
+    """ Returns pickled zlib compressed if it's over COMPRESSION_THRESHOLD and that makes it smaller - otherwise None """
+    if not COMPRESSION_THRESHOLD or len(pickled) < COMPRESSION_THRESHOLD:
+        return None
+    compressed = zlib.compress(pickled)
+    if len(compressed) >= len(pickled):
+        return None
+
+    compressionStats['compressed'] += 1
+    compressionStats['bytesBefore'] += len(pickled)
+    compressionStats['bytesSaved'] += len(pickled) - len(compressed)
+    return compressed
+
+def encodeValue(value, codec=None, marker=VALUE_MARKER):
+    """ Encodes value with codec (DEFAULT_CODEC if not given), tagging it so decodeValue can read it back """
+    codec = codec or DEFAULT_CODEC
+    data = codec.encode(value)
+    if codec is LEGACY_PICKLE_CODEC: # Never compressed, as older readers can't decompress it
+        if marker == DICT_MARKER:
+            return LEGACY_VPICKLE_PREFIX + data
+        return LEGACY_PICKLE_PREFIX + data
+
+    compressed = compressPickle(data)
+    if compressed is not None:
+        return ENCODED_PREFIX + chr(ord(marker) | 1) + codec.tag + compressed
+    return ENCODED_PREFIX + marker + codec.tag + data
+
+def encodedMarker(value):
+    """ Returns the marker byte of a value written by encodeValue, or None if it wasn't """
+    if value.startswith(ENCODED_PREFIX) and len(value) >= ENCODED_HEADER_LENGTH:
+        marker = value[len(ENCODED_PREFIX)]
+        if marker <= COMPRESSED_DICT_MARKER and value[ENCODED_HEADER_LENGTH - 1] in CODECS:
+            return marker
+    return None
+
+def decodeValue(value):
+    """ Decodes a value written by encodeValue (or the legacy pickle format), returning anything else as is """
+    if value and type(value) in types.StringTypes:
+        marker = encodedMarker(value)
+        if marker is not None:
+            data = str(value[ENCODED_HEADER_LENGTH:])
+            if ord(marker) & 1:
+                data = zlib.decompress(data)
+            return CODECS[value[ENCODED_HEADER_LENGTH - 1]].decode(data)
+        elif value.startswith(LEGACY_PICKLE_PREFIX):
+            return pickle.loads(str(value[len(LEGACY_PICKLE_PREFIX):]))
+        elif value.startswith(LEGACY_VPICKLE_PREFIX):
+            return pickle.loads(str(value[len(LEGACY_VPICKLE_PREFIX):]))
+
+    return value
+
+def isEncodedObject(value):
+    """ Returns True if value was encoded as a RedisObject """
+    return encodedMarker(value) in (VALUE_MARKER, COMPRESSED_VALUE_MARKER) or \
+           value.startswith(LEGACY_PICKLE_PREFIX)
+
+def isEncodedDict(value):
+    """ Returns True if value was encoded as a RedisPickledDict """
+    return encodedMarker(value) in (DICT_MARKER, COMPRESSED_DICT_MARKER) or \
+           value.startswith(LEGACY_VPICKLE_PREFIX)
+
+def pickleIfNeeded(value, codec=None):
+    """ Encodes anything that isn't a string - strings are stored as is unless they would be mistaken for an encoded value """
+    if type(value) not in types.StringTypes:
+        return encodeValue(value, codec)
+    if isEncodedObject(value) or isEncodedDict(value):
+        return encodeValue(value, BYTES_CODEC)
+    return value
+
+# Keys a handle has already been type checked for in this process, so new handles to them skip the check
+VALIDATED_KEY_CACHE_SIZE = int(os.environ.get("REDIS_VALIDATED_KEY_CACHE_SIZE", "0")) # 0 disables the cache
+VALIDATED_KEY_TTL = 30 # Seconds before a key gets checked again
+validatedKeys = None
+if VALIDATED_KEY_CACHE_SIZE:
+    validatedKeys = LocalCache(VALIDATED_KEY_CACHE_SIZE, VALIDATED_KEY_TTL)
+
+# Lua applying the ExpiryPolicy whose mode and seconds are ARGV[1] and ARGV[2] to KEYS[1]
+APPLY_EXPIRY_LUA = """
+if ARGV[1] == 'sliding' then
+    redis.call('expire', KEYS[1], ARGV[2])
+elseif ARGV[1] == 'deadline' then
+    redis.call('expireat', KEYS[1], ARGV[2])
+elseif ARGV[1] == 'fixed' and redis.call('ttl', KEYS[1]) == -1 then
+    redis.call('expire', KEYS[1], ARGV[2])
+end
+"""
+
+MUTATE_SCRIPT = redisClient.register_script("""
+local reply
+local changed
+if string.upper(ARGV[3]) == 'ZADD' then
+    -- ZADD only counts new members, CH also counts members whose score moved
+    local size = redis.call('zcard', KEYS[1])
+    changed = redis.call('zadd', KEYS[1], 'ch', (unpack or table.unpack)(ARGV, 4)) > 0
+    reply = redis.call('zcard', KEYS[1]) - size
+else
+    reply = redis.call(ARGV[3], KEYS[1], (unpack or table.unpack)(ARGV, 4))
+    changed = reply
+    if type(reply) == 'number' then
+        changed = reply > 0
+    end
+end
+if changed then
+""" + APPLY_EXPIRY_LUA + """
+end
+return reply
+""")
+
+EXPIRE_IF_PERSISTENT_SCRIPT = redisClient.register_script("""
+if redis.call('ttl', KEYS[1]) == -1 then
+    return redis.call('expire', KEYS[1], ARGV[1])
+end
+return 0
+""")
+
+class ExpiryPolicy(object):
+    """ Describes how an iterable's expiration is kept up to date as it's written to - applied by the server in the
+        same round trip as each write, and only when the write changed something (pushes onto a list and replacing
+        the whole value always do)
+    """
+    __slots__ = ('seconds', )
+    mode = ""
+
+    def __init__(self, seconds=0):
+        self.seconds = int(seconds)
+
+    def apply(self, rclient, key):
+        """ Applies the policy to key after a write using rclient (which may be a pipeline) """
+        pass
+
+
+class NoExpiry(ExpiryPolicy):
+    """ The key never expires """
+    __slots__ = ()
+
+
+class FixedTTL(ExpiryPolicy):
+    """ The key expires seconds after it's created, writes don't extend it """
+    __slots__ = ()
+    mode = "fixed"
+
+    def apply(self, rclient, key):
+        return EXPIRE_IF_PERSISTENT_SCRIPT(keys=[key], args=[self.seconds], client=rclient)
+
+
+class SlidingTTL(ExpiryPolicy):
+    """ The key expires seconds after it was last written to """
+    __slots__ = ()
+    mode = "sliding"
+
+    def apply(self, rclient, key):
+        return rclient.expire(key, self.seconds)
+
+
+class Deadline(ExpiryPolicy):
+    """ The key expires at the unix timestamp seconds, no matter how it's written to """
+    __slots__ = ()
+    mode = "deadline"
+
+    def apply(self, rclient, key):
+        return rclient.expireat(key, self.seconds)
+
+NO_EXPIRY = NoExpiry()
+EXPIRY_UNKNOWN = object()
+BULK_CHUNK_SIZE = 1000 # Values sent per command when writing many values at once
+PAGE_SIZE = 1000 # Values fetched per round trip when iterating over large keys
+REPR_LIMIT = 20 # Members shown when printing sets that may be huge
+QUEUE_LEASE_TIME = 60 # Seconds a consumer has to acknowledge a reserved queue value before it's requeued
+TEMP_KEY_TTL = 60 # Seconds temporary keys live for if whoever made them never cleans them up
+
+def chunks(items, size=BULK_CHUNK_SIZE):
+    """ Splits the list items into lists of at most size items """
+    return [items[start:start + size] for start in xrange(0, len(items), size)]
+
+def tempKey(key):
+    """ Returns a unique key to build a value in before moving it to key """
+    return "%s.tmp.%s" % (key, uuid.uuid4().hex)
+
+class RedisItem(object):
+    """The base redis item type - handles are plain slotted objects so they're cheap to create and can be shared
+       between threads
+    """
+    __slots__ = ('rclient', 'codec', 'key')
     dataType = None
+    readCommand = None # The command (and arguments after the key) that returns the whole value in one call
 
-    def __init__(self, key, defaultValue="", expires=False, rclient=None, create=True):
+    def __init__(self, key, defaultValue="", expires=False, rclient=None, create=True, codec=None, trusted=False):
+        """ trusted - skip checking the key holds this type in redis (and creating it) - for hot paths where
+                      the caller knows it does. Keys are also not rechecked while they're in validatedKeys.
+        """
         self.rclient = rclient or redisClient
+        self.codec = codec or getattr(self.rclient, 'codec', None)
         if isinstance(key, RedisItem):
             key = key.key
         else:
             key = self.inKey(key)
         self.key = key
-        if not self.__correctTypeInRedis__():
-            self.rclient.delete(key)
-            if create:
-                self.resetValue(defaultValue)
+        if not trusted:
+            self.__validate__(defaultValue, create)
         if expires:
             self.rclient.expire(self.key, expires)
 
+    def __validate__(self, defaultValue, create):
+        validatedKey = (self.__class__, id(self.rclient), self.key)
+        if validatedKeys is not None and validatedKeys.get(validatedKey):
+            return
+
+        if self.__correctTypeInRedis__():
+            if validatedKeys is not None:
+                validatedKeys.set(validatedKey, True)
+        else:
+            self.rclient.delete(self.key)
+            if create:
+                self.resetValue(defaultValue)
+
     def __correctTypeInRedis__(self):
         return self.rclient.type(self.key) == self.dataType
 
+    @classmethod
+    def __fromRedis__(cls, rawValue):
+        """ Decodes the reply to readCommand, raising a TypeError if it isn't stored in this item's format """
+        return rawValue
+
+    @classmethod
+    def __writeValue__(cls, rclient, key, value, codec=None):
+        """ Stores value at key using rclient (which may be a pipeline) in this item's format """
+        pass
+
     def __cmp__(self, value):
         if isinstance(value, RedisItem):
             value = value.value()
@@ -253,18 +858,12 @@ class RedisItem(threading.local):
         key = str(key)
         return listReplace(key, KEY_REPLACEMENTS[1], KEY_REPLACEMENTS[0])
 
-    @staticmethod
-    def __pickleIfNeeded__(value):
-        if type(value) not in types.StringTypes:
-            value = "<pckl:>" + pickle.dumps(value)
-        return value
+    def __pickleIfNeeded__(self, value):
+        return pickleIfNeeded(value, self.codec)
 
     @staticmethod
     def __unpickleIfNeeded__(value):
-        if value and type(value) in types.StringTypes and value.startswith("<pckl:>"):
-            return pickle.loads(str(value[7:]))
-
-        return value
+        return decodeValue(value)
 
     def __nonzero__(self):
         return bool(self.value())
@@ -310,10 +909,22 @@ class RedisItem(threading.local):
 
 class RedisObject(RedisItem):
     """RedisObject allows you to set and get pickled objects out of redis"""
+    __slots__ = ()
     dataType = "string"
+    readCommand = ("GET", )
+
+    @classmethod
+    def __fromRedis__(cls, rawValue):
+        if rawValue == None:
+            return None
+        return cls.__unpickleIfNeeded__(rawValue)
+
+    @classmethod
+    def __writeValue__(cls, rclient, key, value, codec=None):
+        return rclient.set(key, pickleIfNeeded(value, codec or getattr(rclient, 'codec', None)))
 
     def resetValue(self, value):
-        return self.rclient.set(self.key, self.__pickleIfNeeded__(value))
+        return self.__writeValue__(self.rclient, self.key, value, self.codec)
 
     def value(self):
         value = self.rclient.get(self.key)
@@ -326,25 +937,35 @@ class RedisPickledDict(RedisItem):
     #1. Faster read than RedisDict
     #2. Slower write than RedisDict
     #3. Atomic read/write for entire dict (RedisDict does not have this)
+    __slots__ = ()
     dataType = "string"
+    readCommand = ("GET", )
 
-    def __init__(self, key, parent=None, defaultValue=None, rclient=None, create=True):
+    def __init__(self, key, parent=None, defaultValue=None, rclient=None, create=True, codec=None, trusted=False):
         if parent != None:
             self.key = parent.key + '.' + key
             key = self.key
         if not defaultValue:
             defaultValue = {}
-        RedisItem.__init__(self, key, defaultValue=defaultValue, rclient=rclient, create=create)
+        RedisItem.__init__(self, key, defaultValue=defaultValue, rclient=rclient, create=create, codec=codec,
+                           trusted=trusted)
 
-    @staticmethod
-    def __vpickleIfNeeded__(value):
-        return "<vpckl:>" + pickle.dumps(value)
+    def __vpickleIfNeeded__(self, value):
+        return encodeValue(value, self.codec, DICT_MARKER)
 
 
     @staticmethod
     def __unvpickleIfNeeded__(value):
-        if value.startswith("<vpckl:>"):
-            return pickle.loads(str(value[8:]))
+        if isEncodedDict(value):
+            return decodeValue(value)
+
+    @classmethod
+    def __fromRedis__(cls, rawValue):
+        if rawValue == None:
+            return None
+        if not isEncodedDict(rawValue):
+            raise TypeError("%s is not a pickled dict" % rawValue)
+        return cls.__unvpickleIfNeeded__(rawValue)
 
     def value(self):
         value = self.rclient.get(self.key)
@@ -353,8 +974,12 @@ class RedisPickledDict(RedisItem):
         else:
             return self.__unvpickleIfNeeded__(value)
 
+    @classmethod
+    def __writeValue__(cls, rclient, key, value, codec=None):
+        return rclient.set(key, encodeValue(value, codec or getattr(rclient, 'codec', None), DICT_MARKER))
+
     def resetValue(self, value):
-        return self.rclient.set(self.key, self.__vpickleIfNeeded__(value))
+        return self.__writeValue__(self.rclient, self.key, value, self.codec)
 
     def update(self, value):
         existingValue = self.value()
@@ -381,18 +1006,32 @@ class RedisPickledDict(RedisItem):
 
 class RedisString(RedisItem):
     """Provides an easy way to manipulate a redis string"""
+    __slots__ = ()
     dataType = "string"
+    readCommand = ("GET", )
 
     def __correctTypeInRedis__(self):
         if RedisItem.__correctTypeInRedis__(self):
             value = self.rclient.get(self.key)
             if value == None:
                 return None
-            return not str(value).startswith('<pckl:>')
+            return not isEncodedObject(value)
         return False
 
+    @classmethod
+    def __fromRedis__(cls, rawValue):
+        if rawValue == None:
+            return None
+        if isEncodedObject(rawValue):
+            raise TypeError("%s is a pickled object" % rawValue)
+        return str(rawValue)
+
+    @classmethod
+    def __writeValue__(cls, rclient, key, value, codec=None):
+        return rclient.set(key, str(value))
+
     def resetValue(self, value):
-        return self.rclient.set(self.key, str(value))
+        return self.__writeValue__(self.rclient, self.key, value)
 
     def value(self):
         value = self.rclient.get(self.key)
@@ -421,13 +1060,20 @@ class RedisString(RedisItem):
 
 class RedisInteger(RedisItem):
     """Provides an easy way to manipulate redis integers"""
+    __slots__ = ()
     dataType = "string"
+    readCommand = ("GET", )
+
+    def __init__(self, key, defaultValue=0, expires=False, rclient=None, create=True, codec=None, trusted=False):
+        RedisItem.__init__(self, key, defaultValue, expires=expires, rclient=rclient, create=create, codec=codec,
+                           trusted=trusted)
 
-    def __init__(self, key, defaultValue=0, expires=False, rclient=None, create=True):
-        RedisItem.__init__(self, key, defaultValue, expires=expires, rclient=rclient, create=create)
+    @classmethod
+    def __writeValue__(cls, rclient, key, value, codec=None):
+        return rclient.set(key, int(value))
 
     def resetValue(self, value):
-        return self.rclient.set(self.key, int(value))
+        return self.__writeValue__(self.rclient, self.key, value)
 
     def value(self):
         value = self.rclient.get(self.key)
@@ -450,6 +1096,14 @@ class RedisInteger(RedisItem):
                 return str(value).isdigit()
         return False
 
+    @classmethod
+    def __fromRedis__(cls, rawValue):
+        if rawValue == None:
+            return None
+        if not str(rawValue).isdigit():
+            raise TypeError("%s is not an integer" % rawValue)
+        return int(rawValue)
+
     def increment(self, amount=1):
         return self.rclient.incr(self.key, amount)
 
@@ -467,18 +1121,33 @@ class RedisInteger(RedisItem):
 
 class RedisBoolean(RedisItem):
     """Provides an easy way to manipulate redis strings as if they where booleans"""
+    __slots__ = ()
     dataType = "string"
+    readCommand = ("GET", )
 
-    def __init__(self, key, defaultValue=False, expires=False, rclient=None, create=True):
-        RedisItem.__init__(self, key, defaultValue, expires, rclient=rclient, create=create)
+    def __init__(self, key, defaultValue=False, expires=False, rclient=None, create=True, codec=None, trusted=False):
+        RedisItem.__init__(self, key, defaultValue, expires, rclient=rclient, create=create, codec=codec,
+                           trusted=trusted)
 
     def __correctTypeInRedis__(self):
         if RedisItem.__correctTypeInRedis__(self):
             return self.rclient.get(self.key) in ('True', 'False', None)
         return False
 
+    @classmethod
+    def __fromRedis__(cls, rawValue):
+        if rawValue == None:
+            return None
+        if rawValue not in ('True', 'False'):
+            raise TypeError("%s is not a boolean" % rawValue)
+        return rawValue == "True"
+
+    @classmethod
+    def __writeValue__(cls, rclient, key, value, codec=None):
+        return rclient.set(key, bool(value))
+
     def resetValue(self, value):
-        return self.rclient.set(self.key, bool(value))
+        return self.__writeValue__(self.rclient, self.key, value)
 
     def value(self):
         value = self.rclient.get(self.key)
@@ -494,16 +1163,20 @@ class RedisBoolean(RedisItem):
 
 class RedisIterable(RedisItem):
     """ AbstractClass - Provides common methods for redis Iterable types """
-
-    def __init__(self, key, defaultValue="", expires=False, rclient=None, create=True):
-        if create:
-            self.rclient = rclient or redisClient
-            self.expirationTime = self.rclient.ttl(key)
-            self.expirationTimestamp = int(time.time())
+    __slots__ = ('expiry', )
+
+    def __init__(self, key, defaultValue="", expires=False, rclient=None, create=True, codec=None, trusted=False,
+                 expiry=None):
+        """ expiry - the ExpiryPolicy applied as the iterable is written to, if not given keys created with a
+                     default keep the expiration they had as a Deadline, otherwise writes leave it alone
+        """
+        if expiry:
+            self.expiry = expiry
+        elif create:
+            self.expiry = EXPIRY_UNKNOWN # Looked up on the first write instead of on every construction
         else:
-            self.expirationTime = None
-            self.expirationTimestamp = int(time.time())
-        RedisItem.__init__(self, key, defaultValue, expires, rclient, create)
+            self.expiry = NO_EXPIRY
+        RedisItem.__init__(self, key, defaultValue, expires, rclient, create, codec, trusted)
 
     def __unpickledList__(self, pythonList):
         pythonList = pythonList or []
@@ -520,8 +1193,7 @@ class RedisIterable(RedisItem):
 
     def expire(self, ttl=0):
         RedisItem.expire(self, ttl)
-        self.expirationTime = ttl
-        self.expirationTimestamp = int(time.time())
+        self.expiry = ttl and Deadline(time.time() + ttl) or NO_EXPIRY
 
     def __nonzero__(self):
         return bool(len(self))
@@ -532,40 +1204,107 @@ class RedisIterable(RedisItem):
     def asSet(self):
         pass
 
-    def handleExpiration(self):
-        if self.expirationTime:
-            now = int(time.time())
-            self.expirationTime -= (now - self.expirationTimestamp)
-            self.expirationTimestamp = now
-            if self.expirationTime <= 0:
-                self.expire(0) # We expired - clear the key.
-            else:
-                self.expire(self.expirationTime)
-
-
+    def expiryPolicy(self):
+        if self.expiry is EXPIRY_UNKNOWN:
+            ttl = self.rclient.ttl(self.key)
+            self.expiry = ttl > 0 and Deadline(time.time() + ttl) or NO_EXPIRY
+        return self.expiry
 
+    def handleExpiration(self):
+        """ Applies the expiry policy now - writes through this object already do so themselves """
+        return self.expiryPolicy().apply(self.rclient, self.key)
+
+    def __mutate__(self, command, *args):
+        """ Runs a write command on this key, applying the expiry policy in the same round trip if it changed anything """
+        return self.__mutateOn__(self.rclient, command, *args)
+
+    def __mutateOn__(self, client, command, *args):
+        """ Runs (or queues if client is a pipeline) a write command on this key using client, applying the expiry
+            policy if it changed anything
+        """
+        policy = self.expiryPolicy()
+        if not policy.mode:
+            return client.execute_command(command, self.key, *args)
+        return MUTATE_SCRIPT(keys=[self.key], args=[policy.mode, policy.seconds, command] + list(args), client=client)
+
+
+LIST_SEARCH_SCRIPT = redisClient.register_script("""
+local length = redis.call('llen', KEYS[1])
+local start = tonumber(ARGV[2])
+local stop = tonumber(ARGV[3]) or length
+if start < 0 then start = math.max(length + start, 0) end
+if stop < 0 then stop = length + stop end
+stop = math.min(stop, length)
+
+local found = 0
+local position = start
+while position < stop do
+    local last = math.min(position + 999, stop - 1)
+    for offset, item in ipairs(redis.call('lrange', KEYS[1], position, last)) do
+        if item == ARGV[1] then
+            if ARGV[4] == 'index' then
+                return position + offset - 1
+            end
+            found = found + 1
+        end
+    end
+    position = last + 1
+end
+if ARGV[4] == 'index' then
+    return -1
+end
+return found
+""")
+
+REQUEUE_STALE_SCRIPT = redisClient.register_script("""
+local requeued = 0
+for _, consumer in ipairs(redis.call('smembers', KEYS[2])) do
+    if redis.call('exists', KEYS[1] .. '.lease.' .. consumer) == 0 then
+        local processing = KEYS[1] .. '.processing.' .. consumer
+        while redis.call('rpoplpush', processing, KEYS[1]) do
+            requeued = requeued + 1
+        end
+        redis.call('srem', KEYS[2], consumer)
+    end
+end
+return requeued
+""")
 
 class RedisList(RedisIterable):
     """Provides a way to manipulate a redis list that feels and acts like a python list"""
+    __slots__ = ()
     dataType = "list"
 
-    def __init__(self, key, defaultValue="", expires=False, rclient=None, create=True):
+    def __init__(self, key, defaultValue="", expires=False, rclient=None, create=True, codec=None, trusted=False,
+                 expiry=None):
         if not defaultValue and create:
             # Create is a no-op on a list with an empty data set
             create = False
-        RedisIterable.__init__(self, key, defaultValue, expires, rclient, create)
+        RedisIterable.__init__(self, key, defaultValue, expires, rclient, create, codec, trusted, expiry)
 
     def resetValue(self, pythonList):
-        retVal = True
-        self.rclient.delete(self.key)
-        if pythonList:
-            for value in pythonList:
-                if not self.append(value):
-                    retVal = False
-                    break
-        self.handleExpiration()
+        """ Replaces the list atomically: it is built under a temporary key and renamed over this one so readers
+            never see it half written
+        """
+        values = [self.__pickleIfNeeded__(value) for value in pythonList or []]
+        if not values:
+            self.rclient.delete(self.key)
+            return True
 
-        return retVal
+        buildKey = tempKey(self.key)
+        pipe = self.rclient.pipeline(transaction=False)
+        for chunk in chunks(values):
+            pipe.rpush(buildKey, *chunk)
+        pipe.expire(buildKey, TEMP_KEY_TTL)
+        pipe.execute()
+
+        pipe = self.rclient.pipeline(transaction=True)
+        pipe.rename(buildKey, self.key)
+        pipe.persist(self.key)
+        self.expiryPolicy().apply(pipe, self.key)
+        pipe.execute()
+
+        return True
 
     def value(self):
         return self.asList()
@@ -578,83 +1317,234 @@ class RedisList(RedisIterable):
 
     def __getitem__(self, index):
         if type(index) == slice:
+            if index.step not in (None, 1):
+                return self.asList()[index]
             start, stop = (index.start or 0, index.stop)
+            if stop == 0:
+                return []
             if stop == None:
-                stop = self.rclient.llen(self.key)
-            return self.__unpickledList__(self.rclient.lrange(self.key, start, stop))
+                stop = 0
+            # Redis ranges include the stop index, python slices don't
+            return self.__unpickledList__(self.rclient.lrange(self.key, start, stop - 1))
 
         return self.__unpickleIfNeeded__(self.rclient.lindex(self.key, index))
 
+    def __iter__(self):
+        return self.iterate()
+
+    def iterate(self, pageSize=PAGE_SIZE, prefetch=False):
+        """ Yields the values in the list fetching pageSize of them at a time, with prefetch the next page is
+            fetched in the background while the current one is being used. Values added or removed while
+            iterating can be skipped or seen twice.
+        """
+        fetchPage = lambda start: self.rclient.lrange(self.key, start, start + pageSize - 1)
+        start = 0
+        page = fetchPage(start)
+        while page:
+            nextPage = None
+            if prefetch and len(page) == pageSize:
+                nextPage = backgroundPool().apply_async(fetchPage, (start + pageSize, ))
+            for item in page:
+                yield self.__unpickleIfNeeded__(item)
+            if len(page) < pageSize:
+                break
+            start += pageSize
+            if nextPage:
+                page = nextPage.get()
+            else:
+                page = fetchPage(start)
+
     def __setitem__(self, index, value):
-        ret = self.rclient.lset(self.key, index, self.__pickleIfNeeded__(value))
-        self.handleExpiration()
-        return ret
+        return self.__mutate__('LSET', index, self.__pickleIfNeeded__(value))
 
     def __delitem__(self, index):
-        ret = self.rclient.lrem(self.key, index)
-        self.handleExpiration()
-        return ret
+        return self.__mutate__('LREM', 0, index)
 
     def asList(self):
-        return self.__unpickledList__(self.rclient.lrange(self.key, 0, self.rclient.llen(self.key)))
+        return self.__unpickledList__(self.rclient.lrange(self.key, 0, -1))
 
     def asSet(self):
-        return self.__unpickledSet__(set(self.rclient.lrange(self.key, 0, self.rclient.llen(self.key))))
+        return self.__unpickledSet__(set(self.rclient.lrange(self.key, 0, -1)))
+
+    def tail(self, count):
+        """ Returns the last count values in the list """
+        if count <= 0:
+            return []
+        return self.__unpickledList__(self.rclient.lrange(self.key, -count, -1))
 
     def sorted(self):
         return self.__unpickledList__(self.rclient.sort(self.key))
 
     def pop(self):
-        ret = self.__unpickleIfNeeded__(self.rclient.lpop(self.key))
-        self.handleExpiration()
-        return ret
+        return self.__unpickleIfNeeded__(self.__mutate__('LPOP'))
+
+    def blockingPop(self, timeout=0):
+        """ Pops the first value, waiting up to timeout seconds (forever if 0) for one to be added - returns None
+            if none was
+        """
+        reply = self.rclient.blpop(self.key, timeout)
+        if reply:
+            return self.__unpickleIfNeeded__(reply[1])
+        return None
+
+    def popMany(self, count):
+        """ Pops up to count values from the front of the list in one round trip """
+        if count <= 0:
+            return []
+        pipe = self.rclient.pipeline(transaction=True)
+        pipe.lrange(self.key, 0, count - 1)
+        pipe.ltrim(self.key, count, -1)
+        return self.__unpickledList__(pipe.execute()[0])
+
+    def processingKey(self, consumer):
+        """ Returns the key of the list holding the values consumer has reserved but not acknowledged yet """
+        return "%s.processing.%s" % (self.key, consumer)
+
+    def reserve(self, consumer, timeout=0, lease=QUEUE_LEASE_TIME):
+        """ Moves the first value into consumer's processing list and returns it, waiting up to timeout seconds
+            for one (None if none came). Unless it's acknowledged, or the lease renewed, within lease seconds
+            requeueStale will put it back on the queue. Needs redis 6.2+ (LMOVE/BLMOVE).
+        """
+        pipe = self.rclient.pipeline(transaction=False)
+        pipe.sadd(self.key + ".consumers", consumer)
+        pipe.set("%s.lease.%s" % (self.key, consumer), int(time.time()), ex=lease)
+        if timeout:
+            pipe.execute_command('BLMOVE', self.key, self.processingKey(consumer), 'LEFT', 'RIGHT', timeout)
+        else:
+            pipe.execute_command('LMOVE', self.key, self.processingKey(consumer), 'LEFT', 'RIGHT')
+        return self.__unpickleIfNeeded__(pipe.execute()[-1])
+
+    def renewLease(self, consumer, lease=QUEUE_LEASE_TIME):
+        """ Keeps consumer's reserved values from being requeued for another lease seconds """
+        return self.rclient.set("%s.lease.%s" % (self.key, consumer), int(time.time()), ex=lease)
+
+    def ack(self, consumer, value):
+        """ Marks a value reserved by consumer as done, removing it from its processing list """
+        return self.rclient.execute_command('LREM', self.processingKey(consumer), 1, self.__pickleIfNeeded__(value))
+
+    def requeueStale(self):
+        """ Puts values reserved by consumers whose lease ran out back at the front of the queue, returning how many
+            were requeued
+        """
+        return REQUEUE_STALE_SCRIPT(keys=[self.key, self.key + ".consumers"], client=self.rclient)
 
     def append(self, value):
-        ret = self.rclient.rpush(self.key, self.__pickleIfNeeded__(value))
-        self.handleExpiration()
-        return ret
+        return self.__mutate__('RPUSH', self.__pickleIfNeeded__(value))
 
     def remove(self, value):
-        ret = self.rclient.lrem(self.key, self.__pickleIfNeeded__(value))
-        self.handleExpiration()
-        return ret
+        return self.__mutate__('LREM', 0, self.__pickleIfNeeded__(value))
 
     def extend(self, valueList):
-        for value in valueList:
-            self.rclient.rpush(self.key, self.__pickleIfNeeded__(value))
-        self.handleExpiration()
+        values = [self.__pickleIfNeeded__(value) for value in valueList]
+        if values:
+            pipe = self.rclient.pipeline(transaction=True)
+            for chunk in chunks(values):
+                pipe.rpush(self.key, *chunk)
+            self.expiryPolicy().apply(pipe, self.key)
+            pipe.execute()
 
         return valueList
 
+    def __search__(self, value, start, stop, mode):
+        """ Searches the list on the server so only the resulting integer comes back """
+        if stop == None:
+            stop = ""
+        return LIST_SEARCH_SCRIPT(keys=[self.key], args=[self.__pickleIfNeeded__(value), start, stop, mode],
+                                  client=self.rclient)
+
     def count(self, value):
-        return self.asList().count(self.__pickleIfNeeded__(value))
+        return self.__search__(value, 0, None, 'count')
+
+    def index(self, value, start=0, stop=None):
+        position = self.__search__(value, start, stop, 'index')
+        if position < 0:
+            raise ValueError("%r is not in list" % (value, ))
+        return position
+
+    def __contains__(self, value):
+        return self.__search__(value, 0, None, 'index') >= 0
+
+
+class RedisCappedList(RedisList):
+    """ A RedisList that's trimmed to at most maxLength values in the same round trip as each write, keeping the
+        newest values (or the oldest if keepNewest is False) - for logs and other ring buffers
+    """
+    __slots__ = ('maxLength', 'keepNewest')
+
+    def __init__(self, key, maxLength, keepNewest=True, defaultValue="", expires=False, rclient=None, create=True,
+                 codec=None, trusted=False, expiry=None):
+        if maxLength < 1:
+            raise ValueError("RedisCappedList maxLength must be at least 1 not %r" % (maxLength, ))
+        self.maxLength = maxLength
+        self.keepNewest = keepNewest
+        RedisList.__init__(self, key, defaultValue, expires, rclient, create, codec, trusted, expiry)
+
+    def __capped__(self, values):
+        """ Returns the part of values that would survive being added to the list """
+        if self.keepNewest:
+            return values[-self.maxLength:]
+        return values[:self.maxLength]
+
+    def __pushAndTrim__(self, values):
+        pipe = self.rclient.pipeline(transaction=True)
+        for chunk in chunks(values):
+            pipe.rpush(self.key, *chunk)
+        if self.keepNewest:
+            pipe.ltrim(self.key, -self.maxLength, -1)
+        else:
+            pipe.ltrim(self.key, 0, self.maxLength - 1)
+        self.expiryPolicy().apply(pipe, self.key)
+        return pipe.execute()
+
+    def resetValue(self, pythonList):
+        return RedisList.resetValue(self, self.__capped__(list(pythonList or [])))
+
+    def append(self, value):
+        """ Adds value to the end of the list, returning the length of the list once it's trimmed """
+        return min(self.__pushAndTrim__([self.__pickleIfNeeded__(value)])[0], self.maxLength)
+
+    def extend(self, valueList):
+        values = self.__capped__([self.__pickleIfNeeded__(value) for value in valueList])
+        if values:
+            self.__pushAndTrim__(values)
+
+        return valueList
 
 
 class RedisSet(RedisIterable):
     """Provides a way to manipulate a redis set that feels and acts like a python set"""
+    __slots__ = ()
     dataType = "set"
 
-    def __init__(self, key, defaultValue="", expires=False, rclient=None, create=True):
+    def __init__(self, key, defaultValue="", expires=False, rclient=None, create=True, codec=None, trusted=False,
+                 expiry=None):
         if not defaultValue and create:
             # Create is a no-op on a set with an empty data set
             create = False
-        RedisIterable.__init__(self, key, defaultValue, expires, rclient, create)
+        RedisIterable.__init__(self, key, defaultValue, expires, rclient, create, codec, trusted, expiry)
 
     def resetValue(self, pythonSet):
-        self.rclient.delete(self.key)
-        if pythonSet:
-            for value in pythonSet:
-                self.add(value)
-        self.handleExpiration()
+        values = [self.__pickleIfNeeded__(value) for value in pythonSet or []]
+        pipe = self.rclient.pipeline(transaction=True)
+        pipe.delete(self.key)
+        if values:
+            for chunk in chunks(values):
+                pipe.sadd(self.key, *chunk)
+            self.expiryPolicy().apply(pipe, self.key)
+        pipe.execute()
 
     def __len__(self):
         return self.rclient.scard(self.key)
 
     def __str__(self):
-        return str(self.asList())
+        """ Shows at most REPR_LIMIT members so printing a huge set doesn't fetch all of it """
+        members = list(itertools.islice(self.iterate(REPR_LIMIT), REPR_LIMIT + 1))
+        if len(members) <= REPR_LIMIT:
+            return str(members)
+        return "%s, ... (%d members)]" % (str(members[:REPR_LIMIT])[:-1], len(self))
 
     def __repr__(self):
-        return str(self.asList())
+        return self.__str__()
 
     def value(self):
         return self.asSet()
@@ -666,25 +1556,73 @@ class RedisSet(RedisIterable):
         return self.__unpickledList__(list(self.rclient.smembers(self.key) or []))
 
     def __iter__(self):
-        return self.asList().__iter__()
+        return self.iterate()
+
+    def iterate(self, pageSize=PAGE_SIZE):
+        """ Yields the members of the set using SSCAN, asking for about pageSize per round trip so the server is never
+            blocked sending the whole set. Members added or removed while iterating may or may not be seen, and a
+            member can occasionally be seen twice.
+        """
+        cursor = 0
+        while True:
+            cursor, members = self.rclient.sscan(self.key, cursor, count=pageSize)
+            for member in members:
+                yield self.__unpickleIfNeeded__(member)
+            if not int(cursor):
+                break
+
+    def sample(self, count):
+        """ Returns count distinct random members (or allows repeats if count is negative) """
+        return self.__unpickledList__(self.rclient.srandmember(self.key, count))
 
     def clear(self):
-        ret = self.delete()
-        self.handleExpiration()
-        return ret
+        return self.delete()
 
     def add(self, value):
-        ret = self.rclient.sadd(self.key, self.__pickleIfNeeded__(value))
-        self.handleExpiration()
-        return ret
+        return self.__mutate__('SADD', self.__pickleIfNeeded__(value))
+
+    def add_many(self, values):
+        """ Adds all of values using chunked SADDs in a single round trip, returning how many were new """
+        return self.__bulkWrite__('SADD', values)
+
+    def remove_many(self, values):
+        """ Removes all of values using chunked SREMs in a single round trip, returning how many were removed """
+        return self.__bulkWrite__('SREM', values)
+
+    def __bulkWrite__(self, command, values):
+        values = [self.__pickleIfNeeded__(value) for value in values]
+        if not values:
+            return 0
+
+        pipe = self.rclient.pipeline(transaction=True)
+        for chunk in chunks(values):
+            self.__mutateOn__(pipe, command, *chunk)
+        return sum(pipe.execute())
+
+    def contains_many(self, values):
+        """ Returns a list of booleans saying if each of values is in the set, checked in a single round trip """
+        values = [self.__pickleIfNeeded__(value) for value in values]
+        if not values:
+            return []
+
+        if not getattr(self.rclient, 'lacksSMISMEMBER', False):
+            try:
+                return [bool(reply) for reply in self.rclient.execute_command('SMISMEMBER', self.key, *values)]
+            except redis.ResponseError as error:
+                if 'unknown command' not in str(error).lower():
+                    raise
+                self.rclient.lacksSMISMEMBER = True # Redis < 6.2 - go straight to the fallback from now on
+
+        pipe = self.rclient.pipeline(transaction=False)
+        for value in values:
+            pipe.sismember(self.key, value)
+        return [bool(reply) for reply in pipe.execute()]
 
     def ismember(self, value):
         return self.rclient.sismember(self.key, self.__pickleIfNeeded__(value))
 
     def remove(self, value):
-        ret = self.rclient.srem(self.key, self.__pickleIfNeeded__(value))
-        self.handleExpiration()
-        return ret
+        return self.__mutate__('SREM', self.__pickleIfNeeded__(value))
 
     def intersection(self, value):
         if type(value) in types.StringTypes + (RedisSet,):
@@ -694,11 +1632,17 @@ class RedisSet(RedisIterable):
 
         return self.asSet().intersection(value)
 
+    def __storeWith__(self, command, value):
+        """ Replaces the set with the result of command on it and the RedisSet or key value - these commands rewrite
+            the key, clearing its expiration, so they go through __mutate__ to have the expiry policy reapplied
+        """
+        if type(value) == RedisSet:
+            value = value.key
+        return self.__mutate__(command, self.key, value)
+
     def intersection_update(self, value):
         if type(value) in types.StringTypes + (RedisSet,):
-            if type(value) == RedisSet:
-                return self.rclient.sinterstore(self.key, (self.key, value.key))
-            return self.rclient.sinterstore(self.key, (self.key, value))
+            return self.__storeWith__('SINTERSTORE', value)
 
         return self.resetValue(self.asSet().intersection(value))
 
@@ -712,11 +1656,9 @@ class RedisSet(RedisIterable):
 
     def difference_update(self, value):
         if type(value) in types.StringTypes + (RedisSet,):
-            if type(value) == RedisSet:
-                return self.rclient.sdiffstore(self.key, (self.key, value.key))
-            return self.rclient.sdiffstore(self.key, (self.key, value))
+            return self.__storeWith__('SDIFFSTORE', value)
 
-        return self.resetValue(self.asSet().difference(value))
+        return self.remove_many(value)
 
     def union(self, value):
         if type(value) in types.StringTypes + (RedisSet,):
@@ -728,18 +1670,202 @@ class RedisSet(RedisIterable):
 
     def update(self, value):
         if type(value) in types.StringTypes + (RedisSet,):
-            if type(value) == RedisSet:
-                return self.rclient.sunionstore(self.key, (self.key, value.key))
-            return self.rclient.sunionstore(self.key (self.key, value))
+            return self.__storeWith__('SUNIONSTORE', value)
 
-        return self.resetValue(self.asSet().union(value))
+        return self.add_many(value)
 
     def pop(self):
-        returnValue = self.__unpickleIfNeeded__(self.rclient.spop(self.key))
-        self.handleExpiration()
-        return returnValue
+        # SPOP is random so it can't be followed by writes inside a script on redis < 5 - its expiry is queued
+        # alongside it instead, which is harmless when the set was empty as there's no key left to expire
+        pipe = self.rclient.pipeline(transaction=True)
+        pipe.spop(self.key)
+        self.expiryPolicy().apply(pipe, self.key)
+        return self.__unpickleIfNeeded__(pipe.execute()[0])
+
+    def __and__(self, other):
+        return RedisSetExpression.combine('SINTERSTORE', self, other)
+
+    def __or__(self, other):
+        return RedisSetExpression.combine('SUNIONSTORE', self, other)
+
+    def __sub__(self, other):
+        return RedisSetExpression.combine('SDIFFSTORE', self, other)
+
+
+class RedisSetExpression(object):
+    """ Set algebra on RedisSets built up with &, | and - (for example (a & b) | (c - d)) that isn't run until its
+        result is asked for with count(), iterate() or store(), and then runs entirely on the server: each step is
+        stored in a temporary key (expiring after TEMP_KEY_TTL) so intermediate sets never cross the network, and
+        intersections are run smallest set first
+    """
+    __slots__ = ('command', 'operands', 'rclient')
+
+    def __init__(self, command, operands, rclient):
+        self.command = command
+        self.operands = operands
+        self.rclient = rclient
+
+    @classmethod
+    def combine(cls, command, left, right):
+        if not isinstance(right, (RedisSet, RedisSetExpression)):
+            return NotImplemented
+        operands = [left, right]
+        # Intersections and unions of intersections and unions can be run as a single command
+        if command != 'SDIFFSTORE':
+            operands = []
+            for operand in (left, right):
+                if isinstance(operand, RedisSetExpression) and operand.command == command:
+                    operands.extend(operand.operands)
+                else:
+                    operands.append(operand)
+        elif isinstance(left, RedisSetExpression) and left.command == command:
+            operands = left.operands + [right]
+        return cls(command, operands, left.rclient)
+
+    def __and__(self, other):
+        return self.combine('SINTERSTORE', self, other)
+
+    def __or__(self, other):
+        return self.combine('SUNIONSTORE', self, other)
+
+    def __sub__(self, other):
+        return self.combine('SDIFFSTORE', self, other)
+
+    def __sets__(self):
+        sets = []
+        for operand in self.operands:
+            if isinstance(operand, RedisSetExpression):
+                sets.extend(operand.__sets__())
+            else:
+                sets.append(operand)
+        return sets
+
+    def __hasIntersection__(self):
+        return self.command == 'SINTERSTORE' or \
+               any(isinstance(operand, RedisSetExpression) and operand.__hasIntersection__()
+                   for operand in self.operands)
+
+    @staticmethod
+    def __operandEstimate__(operand, sizes):
+        if isinstance(operand, RedisSetExpression):
+            return operand.__estimate__(sizes)
+        return sizes[operand.key]
+
+    def __estimate__(self, sizes):
+        """ Estimates the size of the result from the sizes of the sets involved """
+        estimates = [self.__operandEstimate__(operand, sizes) for operand in self.operands]
+        if self.command == 'SINTERSTORE':
+            return min(estimates)
+        elif self.command == 'SUNIONSTORE':
+            return sum(estimates)
+        return estimates[0]
+
+    def __compile__(self, pipe, sizes, tempKeys, destination=None):
+        """ Queues the commands that build this expression on pipe returning the key the result will be in """
+        operands = self.operands
+        if self.command == 'SINTERSTORE' and sizes:
+            operands = sorted(operands, key=lambda operand: self.__operandEstimate__(operand, sizes))
+
+        keys = []
+        for operand in operands:
+            if isinstance(operand, RedisSetExpression):
+                keys.append(operand.__compile__(pipe, sizes, tempKeys))
+            else:
+                keys.append(operand.key)
+
+        if not destination:
+            destination = tempKey(keys[0])
+            tempKeys.append(destination)
+        pipe.execute_command(self.command, destination, *keys)
+        pipe.expire(destination, TEMP_KEY_TTL)
+        return destination
+
+    def __run__(self, destination=None, afterwards=None):
+        """ Builds the result in destination (or a temporary key) and deletes the intermediate keys, queuing
+            afterwards(pipe, resultKey) in the same transaction - returns the result key and the replies
+        """
+        sizes = {}
+        if self.__hasIntersection__():
+            sets = self.__sets__()
+            pipe = self.rclient.pipeline(transaction=False)
+            for redisSet in sets:
+                pipe.scard(redisSet.key)
+            sizes = dict(zip([redisSet.key for redisSet in sets], pipe.execute()))
+
+        tempKeys = []
+        pipe = self.rclient.pipeline(transaction=True)
+        resultKey = self.__compile__(pipe, sizes, tempKeys, destination)
+        intermediateKeys = [key for key in tempKeys if key != resultKey]
+        if intermediateKeys:
+            pipe.delete(*intermediateKeys)
+        if afterwards:
+            afterwards(pipe, resultKey)
+        return resultKey, pipe.execute()
+
+    def count(self):
+        """ Returns the size of the result """
+        def countAndDelete(pipe, resultKey):
+            pipe.scard(resultKey)
+            pipe.delete(resultKey)
+        return self.__run__(afterwards=countAndDelete)[1][-2]
+
+    def __len__(self):
+        return self.count()
+
+    def store(self, key=None, expires=False):
+        """ Stores the result as key (or a temporary key if not given) returning it as a RedisSet """
+        if key:
+            key = RedisItem.inKey(key)
+
+        def setExpiration(pipe, resultKey):
+            if key and expires:
+                pipe.expire(resultKey, expires)
+            elif key:
+                pipe.persist(resultKey)
+        resultKey = self.__run__(key, setExpiration)[0]
+        return RedisSet(resultKey, rclient=self.rclient, trusted=True)
+
+    def iterate(self, pageSize=PAGE_SIZE):
+        """ Yields the members of the result, streamed from a temporary key that's deleted once done - its
+            expiration is pushed back TEMP_KEY_TTL with every page so slow consumers don't lose the rest of it
+        """
+        result = self.store()
+        try:
+            cursor = 0
+            while True:
+                pipe = self.rclient.pipeline(transaction=False)
+                pipe.expire(result.key, TEMP_KEY_TTL).sscan(result.key, cursor, count=pageSize)
+                cursor, members = pipe.execute()[1]
+                for member in members:
+                    yield result.__unpickleIfNeeded__(member)
+                if not int(cursor):
+                    break
+        finally:
+            result.delete()
+
+    def __iter__(self):
+        return self.iterate()
+
+
+ZADD_AUTO_SCORE_SCRIPT = redisClient.register_script("""
+local top = redis.call('zrevrange', KEYS[1], 0, 0, 'withscores')
+local score = 0
+if top[2] then
+    score = tonumber(top[2]) + 1
+end
+local scored = {}
+for index = 3, #ARGV do
+    scored[#scored + 1] = score + index - 3
+    scored[#scored + 1] = ARGV[index]
+end
+local added = redis.call('zadd', KEYS[1], (unpack or table.unpack)(scored))
+-- Every member ends up above the old top score, so something always changed
+""" + APPLY_EXPIRY_LUA + """
+return added
+""")
 
 class RedisSortedSet(RedisIterable):
+    __slots__ = ()
     dataType = "zset"
 
     def __str__(self):
@@ -755,25 +1881,74 @@ class RedisSortedSet(RedisIterable):
         return self.asList()
 
     def asSet(self):
-        return self.__unpickledSet__(self.all())
+        return set(self.all())
 
     def asList(self):
-        return self.__unpickledList__(self.all())
+        return self.all()
 
     def __iter__(self):
         return self.asList().__iter__()
 
+    def iterate(self, pageSize=PAGE_SIZE, withscores=False):
+        """ Yields the members (or (member, score) pairs) in no particular order using ZSCAN, so huge sorted sets can
+            be walked without blocking the server. Members changed while iterating may or may not be seen.
+        """
+        cursor = 0
+        while True:
+            cursor, pairs = self.rclient.zscan(self.key, cursor, count=pageSize)
+            for member, score in pairs:
+                if withscores:
+                    yield (self.__unpickleIfNeeded__(member), score)
+                else:
+                    yield self.__unpickleIfNeeded__(member)
+            if not int(cursor):
+                break
+
+    def __unpickledPairs__(self, pairs):
+        return [(self.__unpickleIfNeeded__(member), score) for member, score in pairs or []]
+
+    def __unpickledRange__(self, reply, withscores):
+        if withscores:
+            return self.__unpickledPairs__(reply)
+        return self.__unpickledList__(reply)
+
     def clear(self):
         return self.delete()
 
     def resetValue(self, pythonSet):
-        self.rclient.delete(self.key)
-        if pythonSet:
-            for value in pythonSet:
-                self.add(value)
-        self.handleExpiration()
-        if self.expirationTime:
-            self.expire(self.expirationTime)
+        pipe = self.rclient.pipeline(transaction=True)
+        pipe.delete(self.key)
+        self.__queueAdds__(pipe, pythonSet or [])
+        pipe.execute()
+
+    def add_many(self, values, scored=False):
+        """ Adds all of values in a single atomic round trip, returning how many were new:
+                values - the members to add, each scored one higher than the current top score in order, or
+                         (member, score) pairs if scored is True
+        """
+        pipe = self.rclient.pipeline(transaction=True)
+        commands = self.__queueAdds__(pipe, values, scored)
+        if not commands:
+            return 0
+        return sum(pipe.execute()[:commands])
+
+    def __queueAdds__(self, pipe, values, scored=False):
+        """ Queues chunked ZADDs of values on pipe - auto scored on the server unless scored - each applying the
+            expiry policy if it changed anything, returning how many commands were queued
+        """
+        if scored:
+            scoredValues = []
+            for value, score in values:
+                scoredValues.extend((score, self.__pickleIfNeeded__(value)))
+            valueChunks = chunks(scoredValues, BULK_CHUNK_SIZE * 2)
+            for chunk in valueChunks:
+                self.__mutateOn__(pipe, 'ZADD', *chunk)
+        else:
+            policy = self.expiryPolicy()
+            valueChunks = chunks([self.__pickleIfNeeded__(value) for value in values])
+            for chunk in valueChunks:
+                ZADD_AUTO_SCORE_SCRIPT(keys=[self.key], args=[policy.mode, policy.seconds] + chunk, client=pipe)
+        return len(valueChunks)
 
     def __len__(self):
         return self.rclient.zcard(self.key)
@@ -781,31 +1956,163 @@ class RedisSortedSet(RedisIterable):
     def score(self, value):
         return self.rclient.zscore(self.key, self.__pickleIfNeeded__(value))
 
+    def rank(self, value, reverse=False):
+        """ Returns the position of value ordered by score (highest first if reverse), or None if it isn't a member """
+        if reverse:
+            return self.rclient.zrevrank(self.key, self.__pickleIfNeeded__(value))
+        return self.rclient.zrank(self.key, self.__pickleIfNeeded__(value))
+
+    def top(self, count, withscores=True):
+        """ Returns the count highest scoring members, highest first, as (member, score) pairs unless withscores is
+            False
+        """
+        if count <= 0:
+            return []
+        return self.__unpickledRange__(self.rclient.zrevrange(self.key, 0, count - 1, withscores=withscores),
+                                       withscores)
+
+    def rangeByScore(self, minimum='-inf', maximum='+inf', start=None, num=None, withscores=False, reverse=False):
+        """ Returns the members scored between minimum and maximum (prefix with '(' to exclude a bound), skipping
+            start and returning at most num of them, highest scores first if reverse
+        """
+        if reverse:
+            reply = self.rclient.zrevrangebyscore(self.key, maximum, minimum, start, num, withscores)
+        else:
+            reply = self.rclient.zrangebyscore(self.key, minimum, maximum, start, num, withscores)
+        return self.__unpickledRange__(reply, withscores)
+
+    def rangeByLex(self, minimum='-', maximum='+', start=None, num=None, reverse=False):
+        """ Returns members between minimum and maximum ('[' or '(' prefixed for inclusive or exclusive bounds) for
+            sets where every member has the same score - only meaningful for string members as others are stored
+            encoded
+        """
+        if reverse:
+            return self.__unpickledList__(self.rclient.zrevrangebylex(self.key, maximum, minimum, start, num))
+        return self.__unpickledList__(self.rclient.zrangebylex(self.key, minimum, maximum, start, num))
+
+    def incrementScore(self, value, amount=1):
+        """ Adds amount to value's score (adding value if needed) returning the new score """
+        return float(self.__mutate__('ZINCRBY', amount, self.__pickleIfNeeded__(value)))
+
     def add(self, value, score=None):
-        if not score:
-            score = len(self)
-        ret = self.rclient.zadd(self.key, self.__pickleIfNeeded__(value), score)
-        self.handleExpiration()
-        return ret
+        """ Adds value with score, or scored one higher than the current top score (atomically) if score is None """
+        if score is None:
+            return self.add_many((value, ))
+        return self.__mutate__('ZADD', score, self.__pickleIfNeeded__(value))
 
     def __getitem__(self, index):
         if type(index) == slice:
+            if index.step not in (None, 1):
+                return self.all()[index]
             start, stop = (index.start or 0, index.stop)
+            if stop == 0:
+                return []
             if stop == None:
-                stop = len(self)
-            return self.__unpickledList__(self.rclient.zrange(self.key, start, stop))
+                stop = 0
+            # Redis ranges include the stop index, python slices don't
+            return self.__unpickledList__(self.rclient.zrange(self.key, start, stop - 1))
 
         return self.__unpickleIfNeeded__(self.rclient.zrange(self.key, index, index)[0])
 
     def remove(self, value):
-        return self.rclient.zrem(self.key, self.__pickleIfNeeded__(value))
+        return self.__mutate__('ZREM', self.__pickleIfNeeded__(value))
+
+RATE_LIMIT_SCRIPT = redisClient.register_script("""
+redis.call('zremrangebyscore', KEYS[1], '-inf', '(' .. ARGV[4])
+if redis.call('zcard', KEYS[1]) >= tonumber(ARGV[5]) then
+    return 0
+end
+redis.call('zadd', KEYS[1], ARGV[3], ARGV[6])
+""" + APPLY_EXPIRY_LUA + """
+return 1
+""")
+
+class RedisTimeWindow(RedisSortedSet):
+    """ A RedisSortedSet of values scored by the time they happened, where anything older than windowSeconds is
+        pruned in the same round trip as each write - for event logs and sliding window rate limiting. Values are
+        members of a set, so add unique values (or use allow) to record repeated events. Expires windowSeconds after
+        the last write unless given another expiry.
+    """
+    __slots__ = ('windowSeconds', )
+
+    def __init__(self, key, windowSeconds, defaultValue="", expires=False, rclient=None, create=True, codec=None,
+                 trusted=False, expiry=None):
+        self.windowSeconds = windowSeconds
+        RedisSortedSet.__init__(self, key, defaultValue, expires, rclient, create, codec, trusted,
+                                expiry or SlidingTTL(math.ceil(windowSeconds)))
+
+    def windowStart(self, now=None):
+        """ Returns the oldest timestamp still inside the window """
+        return (now or time.time()) - self.windowSeconds
+
+    def __queuePrune__(self, pipe, now=None):
+        pipe.execute_command('ZREMRANGEBYSCORE', self.key, '-inf', '(%r' % self.windowStart(now))
+
+    def __queueAdds__(self, pipe, values, scored=False):
+        """ Stamps values with the current time unless they are already (value, timestamp) pairs, then queues
+            pruning the values that fell out of the window
+        """
+        if not scored:
+            now = time.time()
+            values = [(value, now) for value in values]
+        commands = RedisSortedSet.__queueAdds__(self, pipe, values, True)
+        if commands:
+            self.__queuePrune__(pipe)
+        return commands
+
+    def add(self, value, timestamp=None):
+        """ Records value as happening at timestamp (now if not given) """
+        return self.add_many(((value, timestamp or time.time()), ), scored=True)
+
+    def prune(self):
+        """ Removes the values that fell out of the window, returning how many there were """
+        return self.rclient.execute_command('ZREMRANGEBYSCORE', self.key, '-inf', '(%r' % self.windowStart())
+
+    def count_since(self, timestamp=None):
+        """ Returns how many values happened at or after timestamp (the start of the window if not given) """
+        return self.rclient.zcount(self.key, timestamp or self.windowStart(), '+inf')
+
+    def window(self, start=None, end=None, withscores=False):
+        """ Returns the values that happened between the timestamps start (the start of the window if not given)
+            and end, oldest first
+        """
+        return self.rangeByScore(start or self.windowStart(), end or '+inf', withscores=withscores)
+
+    def allow(self, limit):
+        """ Sliding window rate limiting: records an event and returns True if fewer than limit happened within the
+            window, otherwise records nothing and returns False - checked and recorded atomically on the server
+        """
+        now = time.time()
+        policy = self.expiryPolicy()
+        return bool(RATE_LIMIT_SCRIPT(keys=[self.key],
+                                      args=[policy.mode, policy.seconds, repr(now), repr(self.windowStart(now)),
+                                            limit, "%r:%s" % (now, uuid.uuid4().hex)],
+                                      client=self.rclient))
 
 class RedisDict(RedisItem):
     """ Allows you to modify values/keys in redis as if it's a python dictionary using the native redis hash:
            Faster and uses a lot less memory than RedisDict, however doesn't support
            individual key expires.
     """
+    __slots__ = ()
     dataType = "hash"
+    readCommand = ("HGETALL", )
+
+    @classmethod
+    def __fromRedis__(cls, rawValue):
+        if not rawValue:
+            return None # Redis doesn't keep empty hashes around
+        for key, value in rawValue.iteritems():
+            rawValue[key] = cls.__unpickleIfNeeded__(value)
+        return rawValue
+
+    @classmethod
+    def __writeValue__(cls, rclient, key, value, codec=None):
+        codec = codec or getattr(rclient, 'codec', None)
+        rclient.delete(key)
+        if value:
+            return rclient.hmset(key, dict((field, pickleIfNeeded(fieldValue, codec))
+                                           for field, fieldValue in value.iteritems()))
 
     def __getitem__(self, key):
         value = self.rclient.hget(self.key, key)
@@ -826,9 +2133,11 @@ class RedisDict(RedisItem):
         return self.asDict()
 
     def resetValue(self, valueDictionary=None):
-        self.clear()
-        if valueDictionary:
-            return self.update(valueDictionary)
+        """ Replaces the hash with valueDictionary in one atomic round trip """
+        pipe = self.rclient.pipeline(transaction=True)
+        pipe.delete(self.key)
+        self.__queueUpdate__(pipe, valueDictionary or {})
+        pipe.execute()
 
     def asDict(self):
         dictionary = self.rclient.hgetall(self.key)
@@ -855,6 +2164,38 @@ class RedisDict(RedisItem):
     def items(self):
         return self.asDict().items()
 
+    def iteritems(self, pageSize=PAGE_SIZE, match=None):
+        """ Yields (key, value) pairs using HSCAN, asking for about pageSize fields per round trip and decoding values
+            as they're reached, so huge hashes can be walked without holding them in memory or blocking the server:
+                match - only yield keys matching this glob style pattern
+            Fields changed while iterating may or may not be seen, and a field can occasionally be seen twice.
+        """
+        for fields in self.__scan__(pageSize, match):
+            for key, value in fields.iteritems():
+                yield (key, self.__unpickleIfNeeded__(value))
+
+    def __scan__(self, pageSize, match):
+        """ Yields each page of raw fields HSCAN returns """
+        cursor = 0
+        while True:
+            cursor, fields = self.rclient.hscan(self.key, cursor, match=match, count=pageSize)
+            yield fields
+            if not int(cursor):
+                break
+
+    def iterkeys(self, pageSize=PAGE_SIZE, match=None):
+        """ Yields the keys using HSCAN without decoding their values - see iteritems """
+        for fields in self.__scan__(pageSize, match):
+            for key in fields:
+                yield key
+
+    def itervalues(self, pageSize=PAGE_SIZE, match=None):
+        """ Yields the values using HSCAN - see iteritems """
+        return (value for key, value in self.iteritems(pageSize, match))
+
+    def __iter__(self):
+        return self.iterkeys()
+
     def has_key(self, key):
         return self.rclient.hexists(self.key, key)
 
@@ -862,43 +2203,311 @@ class RedisDict(RedisItem):
         return self.has_key(key)
 
     def update(self, updateDictionary):
-        for key, value in updateDictionary.iteritems():
-            self.__setitem__(key, value)
+        """ Writes every field in updateDictionary with chunked HMSETs in a single atomic round trip """
+        pipe = self.rclient.pipeline(transaction=True)
+        if self.__queueUpdate__(pipe, updateDictionary):
+            pipe.execute()
 
         return True
 
+    def __queueUpdate__(self, pipe, updateDictionary):
+        """ Queues chunked HMSETs of updateDictionary on pipe returning how many were queued """
+        fieldsAndValues = []
+        for key, value in updateDictionary.iteritems():
+            fieldsAndValues.extend((key, self.__pickleIfNeeded__(value)))
+        fieldChunks = chunks(fieldsAndValues, BULK_CHUNK_SIZE * 2)
+        for chunk in fieldChunks:
+            pipe.execute_command('HMSET', self.key, *chunk)
+        return len(fieldChunks)
+
     def pop(self, key, default=None):
-        value = self.get(key, None)
-        if not self.__delitem__(key):
+        pipe = self.rclient.pipeline(transaction=True)
+        value, deleted = pipe.hget(self.key, key).hdel(self.key, key).execute()
+        if not deleted:
             return default
-        return value
+        return self.__unpickleIfNeeded__(value)
 
     def clear(self):
         return self.rclient.delete(self.key)
 
     def get(self, key, default=None):
-        if self.has_key(key):
-            return self[key]
+        value = self.rclient.hget(self.key, key)
+        if value == None:
+            return default
 
-        return default
+        return self.__unpickleIfNeeded__(value)
+
+    def get_many(self, keys, default=None):
+        """ Returns the values of keys in one call, in the same order, using default for any that aren't set """
+        keys = list(keys)
+        if not keys:
+            return []
+        return [default if value == None else self.__unpickleIfNeeded__(value)
+                for value in self.rclient.hmget(self.key, keys)]
 
     def __delitem__(self, key):
         return self.rclient.hdel(self.key, key)
 
     def setdefault(self, key, defaultValue):
-        if not self.has_key(key):
-            self[key] = defaultValue
-
-        return self[key]
+        pipe = self.rclient.pipeline(transaction=True)
+        pipe.hsetnx(self.key, key, self.__pickleIfNeeded__(defaultValue)).hget(self.key, key)
+        return self.__unpickleIfNeeded__(pipe.execute()[1])
 
     def __len__(self):
         return self.rclient.hlen(self.key)
 
+class NearCache(object):
+    """ The in process mirror of one hash shared by every RedisNearDict handle to it, kept coherent by a daemon
+        thread subscribed to the invalidation channel and the key's keyspace notifications - get one with
+        nearCache() rather than creating it directly
+    """
+    __slots__ = ('rclient', 'key', 'channel', 'mirror', 'loadedAt', 'generation', 'subscribed', 'closed', 'lock',
+                 'thread')
+
+    def __init__(self, rclient, key, channel):
+        self.rclient = rclient
+        self.key = key
+        self.channel = channel
+        self.mirror = None
+        self.loadedAt = 0
+        self.generation = 0
+        self.subscribed = False
+        self.closed = False
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.subscribe, name="NearCache(%s)" % key)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def subscribe(self):
+        """ Keeps a subscription to the invalidation channel and the key's keyspace notifications open until closed,
+            dropping the mirror on every message and whenever the subscription is (re)established
+        """
+        database = self.rclient.connection_pool.connection_kwargs.get('db', 0)
+        channels = (self.channel, "__keyspace@%s__:%s" % (database, self.key))
+        while not self.closed:
+            pubsub = self.rclient.pubsub()
+            try:
+                pubsub.subscribe(*channels)
+                confirmed = 0
+                while not self.closed:
+                    message = pubsub.get_message(timeout=NEAR_CACHE_RETRY_INTERVAL)
+                    if not message:
+                        continue
+                    if message['type'] == 'subscribe':
+                        confirmed += 1
+                        if confirmed == len(channels):
+                            self.invalidate() # Anything could have changed while we weren't listening
+                            self.subscribed = True
+                    else:
+                        self.invalidate()
+            except redis.RedisError:
+                self.subscribed = False
+                self.invalidate()
+                time.sleep(NEAR_CACHE_RETRY_INTERVAL)
+            finally:
+                self.subscribed = False
+                pubsub.close()
+
+    def close(self):
+        """ Stops the subscriber thread, waiting for it to finish, and forgets the mirror """
+        with nearCachesLock:
+            if nearCaches.get((id(self.rclient), self.key, self.channel)) is self:
+                del nearCaches[(id(self.rclient), self.key, self.channel)]
+        self.closed = True
+        self.invalidate()
+        if self.thread is not threading.current_thread():
+            self.thread.join(NEAR_CACHE_RETRY_INTERVAL * 2)
+
+    def invalidate(self):
+        """ Drops the mirror so the next read reloads it """
+        with self.lock:
+            self.generation += 1
+            self.mirror = None
+
+    def get(self, maxStaleness):
+        """ Returns the raw mirrored hash, reloading it if it's older than maxStaleness, or None if reads must go
+            to redis
+        """
+        if not self.subscribed:
+            return None
+        mirror = self.mirror
+        if mirror is not None and time.time() - self.loadedAt <= maxStaleness:
+            return mirror
+
+        generation = self.generation
+        mirror = self.rclient.hgetall(self.key)
+        with self.lock:
+            if generation == self.generation: # Nothing was invalidated while loading
+                self.mirror = mirror
+                self.loadedAt = time.time()
+        return mirror
+
+nearCaches = {}
+nearCachesLock = threading.Lock()
+
+def nearCache(rclient, key, channel):
+    """ Returns the NearCache for key on rclient, starting it the first time it's asked for """
+    with nearCachesLock:
+        shared = nearCaches.get((id(rclient), key, channel))
+        if shared is None:
+            shared = nearCaches[(id(rclient), key, channel)] = NearCache(rclient, key, channel)
+        return shared
+
+class RedisNearDict(RedisDict):
+    """ A RedisDict mirrored in process so reads don't need a round trip - for small, hot hashes like config and
+        feature flags. The mirror is dropped whenever a message arrives on the invalidation channel (published on
+        every write made through a RedisNearDict) or a keyspace notification for the key (if the server has
+        notify-keyspace-events enabled for hashes), and reloaded with one HGETALL on the next read:
+            maxStaleness - seconds a mirror is used before it's reloaded even without an invalidation
+            channel - the pub/sub channel writers publish invalidations on, by default "<key>.invalidate"
+        Handles are cheap to create inline: every handle to the same key and client shares one mirror, subscriber
+        thread and pub/sub connection, which live until close() is called on any of them - other handles then
+        start a new one on their next read. While the subscription is down reads go straight to redis.
+    """
+    __slots__ = ('maxStaleness', 'channel', 'nearCache')
+
+    def __init__(self, key, maxStaleness=NEAR_CACHE_MAX_STALENESS, defaultValue="", expires=False, rclient=None,
+                 create=True, codec=None, trusted=False, channel=None):
+        self.maxStaleness = maxStaleness
+        self.channel = channel or "%s.invalidate" % key
+        self.nearCache = None
+        RedisDict.__init__(self, key, defaultValue, expires, rclient, create, codec, trusted)
+        self.nearCache = nearCache(self.rclient, self.key, self.channel)
+
+    def close(self):
+        """ Stops the shared subscriber thread for this hash - the next read through any handle starts another """
+        self.nearCache.close()
+
+    def invalidate(self):
+        """ Drops the mirror so the next read reloads it """
+        if self.nearCache:
+            self.nearCache.invalidate()
+
+    def __mirror__(self):
+        """ Returns the raw mirrored hash, or None if reads must go to redis """
+        if not self.nearCache:
+            return None
+        if self.nearCache.closed: # Closed through another handle
+            self.nearCache = nearCache(self.rclient, self.key, self.channel)
+        return self.nearCache.get(self.maxStaleness)
+
+    @staticmethod
+    def __field__(key):
+        """ Returns key as redis returns it in HGETALL replies """
+        if isinstance(key, unicode):
+            return key.encode('utf-8')
+        return str(key)
+
+    def __publish__(self):
+        """ Tells every mirror of this hash (including this one, straight away) to reload after a write """
+        self.rclient.publish(self.channel, self.key)
+        self.invalidate()
+
+    def __getitem__(self, key):
+        mirror = self.__mirror__()
+        if mirror is None:
+            return RedisDict.__getitem__(self, key)
+        field = self.__field__(key)
+        if field not in mirror:
+            raise KeyError(key)
+        return self.__unpickleIfNeeded__(mirror[field])
+
+    def get(self, key, default=None):
+        mirror = self.__mirror__()
+        if mirror is None:
+            return RedisDict.get(self, key, default)
+        field = self.__field__(key)
+        if field not in mirror:
+            return default
+        return self.__unpickleIfNeeded__(mirror[field])
+
+    def get_many(self, keys, default=None):
+        mirror = self.__mirror__()
+        if mirror is None:
+            return RedisDict.get_many(self, keys, default)
+        fields = [self.__field__(key) for key in keys]
+        return [self.__unpickleIfNeeded__(mirror[field]) if field in mirror else default for field in fields]
+
+    def has_key(self, key):
+        mirror = self.__mirror__()
+        if mirror is None:
+            return RedisDict.has_key(self, key)
+        return self.__field__(key) in mirror
+
+    def keys(self):
+        mirror = self.__mirror__()
+        if mirror is None:
+            return RedisDict.keys(self)
+        return mirror.keys()
+
+    def values(self):
+        return self.asDict().values()
+
+    def asDict(self):
+        mirror = self.__mirror__()
+        if mirror is None:
+            return RedisDict.asDict(self)
+        return dict((key, self.__unpickleIfNeeded__(value)) for key, value in mirror.iteritems())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        mirror = self.__mirror__()
+        if mirror is None:
+            return RedisDict.__len__(self)
+        return len(mirror)
+
+    def __setitem__(self, key, value):
+        pipe = self.rclient.pipeline(transaction=True)
+        pipe.hset(self.key, key, self.__pickleIfNeeded__(value)).publish(self.channel, self.key)
+        reply = pipe.execute()[0]
+        self.invalidate()
+        return reply
+
+    def __delitem__(self, key):
+        pipe = self.rclient.pipeline(transaction=True)
+        pipe.hdel(self.key, key).publish(self.channel, self.key)
+        reply = pipe.execute()[0]
+        self.invalidate()
+        return reply
+
+    def resetValue(self, valueDictionary=None):
+        RedisDict.resetValue(self, valueDictionary)
+        self.__publish__()
+
+    def update(self, updateDictionary):
+        RedisDict.update(self, updateDictionary)
+        self.__publish__()
+        return True
+
+    def pop(self, key, default=None):
+        value = RedisDict.pop(self, key, default)
+        self.__publish__()
+        return value
+
+    def setdefault(self, key, defaultValue):
+        value = RedisDict.setdefault(self, key, defaultValue)
+        self.__publish__()
+        return value
+
+    def clear(self):
+        deleted = RedisDict.clear(self)
+        self.__publish__()
+        return deleted
+
+    def delete(self):
+        deleted = RedisDict.delete(self)
+        self.__publish__()
+        return deleted
+
 class RedisKeyDict(RedisItem):
     """ Allows you to modify values/keys in redis as if it's a python dictionary using nested redis keys"""
+    __slots__ = ('metaInfo', '__objectCache__')
 
     def __init__(self, key, expires=False, rclient=None):
         self.key = self.inKey(key)
+        self.codec = None
         self.__objectCache__ = {}
         self.metaInfo = RedisString(key, defaultValue="<dict:>", expires=expires)
         self.rclient = rclient or redisClient
@@ -924,9 +2533,9 @@ class RedisKeyDict(RedisItem):
             redisValue = self.rclient.get(self.key + "." + key)
             if redisValue.isdigit():
                 redisObjectType = RedisInteger
-            elif redisValue.startswith("<pckl:>"):
+            elif isEncodedObject(redisValue):
                 redisObjectType = RedisObject
-            elif redisValue.startswith("<vpckl:>"):
+            elif isEncodedDict(redisValue):
                 redisObjectType = RedisPickledDict
             elif redisValue == "<dict:>":
                 redisObjectType = RedisKeyDict
@@ -1100,6 +2709,7 @@ class RedisKeyDict(RedisItem):
 
 class RedisLock(RedisList):
     ''' A locking mechanism implemented in Redis safe and atomic across multiple machines '''
+    __slots__ = ('lastAcquireTime', )
     RESULT_TIMEOUT = "__~~THERE_WAS_A_TIMEOUT~~__9191919192828383" # Return if timeout exceeded
     RESULT_LOSTKEY = "__~~THERE_WAS_A_LISTCLEAR~~__9191912938293892" #List cleared. You should retry.
     MAX_KEYHOLD = 60 # Seconds for the maximum someone can hold the lock
@@ -0,0 +1,66 @@
+""" A fakeredis client that counts the round trips, commands and reply bytes it exchanges with the (fake) server,
+    so tests and benchmarks can measure what RedisStore sends over the wire without a redis server running
+"""
+
+import fakeredis
+from fakeredis._server import FakeConnection
+from redis.client import BasePipeline
+
+
+def replySize(reply):
+    """ Approximates how many payload bytes a reply took on the wire """
+    if isinstance(reply, (list, tuple)):
+        return sum(replySize(item) for item in reply)
+    if reply is None:
+        return 0
+    if isinstance(reply, (int, long, float)):
+        return len(str(reply))
+    return len(reply)
+
+
+class Counts(object):
+    """ What a CountingRedis client has sent and received since it was last reset """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.roundTrips = 0
+        self.commands = []
+        self.bytesRead = 0
+
+
+class CountingConnection(FakeConnection):
+    counts = None
+
+    def send_packed_command(self, command):
+        self.counts.roundTrips += 1
+        return FakeConnection.send_packed_command(self, command)
+
+    def pack_command(self, *args):
+        self.counts.commands.append(args[0])
+        return FakeConnection.pack_command(self, *args)
+
+    def read_response(self):
+        response = FakeConnection.read_response(self)
+        self.counts.bytesRead += replySize(response)
+        return response
+
+
+def loadScripts(pipeline):
+    """ Loads a pipeline's scripts with SCRIPT LOAD alone - fakeredis doesn't implement the SCRIPT EXISTS that
+        redis-py checks with first, which otherwise breaks any script run on a pipeline
+    """
+    for script in pipeline.scripts:
+        script.sha = pipeline.immediate_execute_command('SCRIPT', 'LOAD', script.script)
+
+BasePipeline.load_scripts = loadScripts
+
+
+def CountingRedis():
+    """ Returns a new fakeredis client (with its own server) whose traffic is tallied in its counts attribute """
+    client = fakeredis.FakeRedis()
+    client.counts = Counts()
+    client.connection_pool.connection_class = type('CountingConnection', (CountingConnection, ),
+                                                   {'counts': client.counts})
+    return client
@@ -0,0 +1,65 @@
+""" Compares the memory and allocation cost of RedisStore's slotted item handles with the threading.local based
+    handles they replaced. Run with: python benchmark_handles.py [handles]
+"""
+
+import gc
+import os
+import sys
+import threading
+import time
+
+# Imported before RedisStore, which replaces redis.Redis with its own subclass
+from CountingRedis import CountingRedis
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Import RedisStore from this checkout
+import RedisStore
+
+HANDLES = 100000
+
+
+class LocalHandle(threading.local):
+    """ The attributes a RedisList handle carried when RedisItem subclassed threading.local """
+
+    def __init__(self, key, rclient):
+        self.rclient = rclient
+        self.key = key
+        self.expirationTime = None
+        self.expirationTimestamp = int(time.time())
+
+
+def handleSize(handle):
+    """ Returns the bytes held by handle itself - its instance dict included if it has one """
+    size = sys.getsizeof(handle)
+    if hasattr(handle, '__dict__'):
+        size += sys.getsizeof(handle.__dict__)
+    return size
+
+
+def measure(name, create, count):
+    gc.collect()
+    objectsBefore = len(gc.get_objects())
+    startedAt = time.time()
+    handles = [create("key%d" % index) for index in xrange(count)]
+    elapsed = time.time() - startedAt
+    allocated = len(gc.get_objects()) - objectsBefore - 1 # The list holding them
+
+    print("%-28s %10.2f %12.1f %14.2f" % (name, handleSize(handles[0]), float(allocated) / count,
+                                        elapsed / count * 1000000))
+    return handles
+
+
+def main(count=HANDLES):
+    client = CountingRedis()
+    print("%d handles" % count)
+    print("%-28s %10s %12s %14s" % ("", "bytes each", "gc objects", "microseconds"))
+    measure("threading.local handle", lambda key: LocalHandle(key, client), count)
+    measure("RedisList(trusted=True)", lambda key: RedisStore.RedisList(key, rclient=client, trusted=True),
+            count)
+
+    client.counts.reset()
+    RedisStore.RedisList("key", rclient=client, trusted=True)
+    print("round trips to create a trusted handle: %d" % client.counts.roundTrips)
+
+
+if __name__ == '__main__':
+    main(*[int(argument) for argument in sys.argv[1:]])
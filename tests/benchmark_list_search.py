@@ -0,0 +1,48 @@
+""" Compares the reply bytes and round trips of RedisList count, index and membership tests run on the server with
+    downloading the whole list and searching it in python, as they used to. Run with:
+    python benchmark_list_search.py [listLength]
+"""
+
+import os
+import sys
+
+# Imported before RedisStore, which replaces redis.Redis with its own subclass
+from CountingRedis import CountingRedis
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Import RedisStore from this checkout
+import RedisStore
+
+LIST_LENGTH = 10000
+
+
+def downloaded(redisList):
+    return redisList.__unpickledList__(redisList.rclient.lrange(redisList.key, 0, -1))
+
+
+def measure(client, name, search):
+    client.counts.reset()
+    result = search()
+    return "%-14s %-8s %12d %12d" % (name, result, client.counts.bytesRead, client.counts.roundTrips)
+
+
+def main(length=LIST_LENGTH):
+    client = CountingRedis()
+    values = [{'id': index, 'name': "value %d" % index} for index in xrange(length)]
+    redisList = RedisStore.RedisList("benchmark", defaultValue=values, rclient=client)
+    needle = values[length * 3 // 4]
+    redisList.count(needle) # Loads the search script so its first run isn't counted
+
+    print("%d values" % length)
+    print("%-14s %-8s %12s %12s" % ("", "result", "reply bytes", "round trips"))
+    for name, before, after in (("count", lambda: downloaded(redisList).count(needle),
+                                          lambda: redisList.count(needle)),
+                                ("index", lambda: downloaded(redisList).index(needle),
+                                          lambda: redisList.index(needle)),
+                                ("in", lambda: needle in downloaded(redisList),
+                                       lambda: needle in redisList)):
+        print(measure(client, name + " before", before))
+        print(measure(client, name + " after", after))
+
+
+if __name__ == '__main__':
+    main(*[int(argument) for argument in sys.argv[1:]])
@@ -0,0 +1,407 @@
+import cPickle as pickle
+import os
+import sys
+import time
+import unittest
+
+# Imported before RedisStore, which replaces redis.Redis with its own subclass
+try:
+    from CountingRedis import CountingRedis
+except ImportError: # fakeredis isn't installed
+    CountingRedis = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Import RedisStore from this checkout
+import RedisStore
+
+
+@unittest.skipIf(CountingRedis is None, "needs fakeredis")
+class TestCacheHits(unittest.TestCase):
+    """ A cache hit should cost a single round trip: the read and the TTL refresh are pipelined together and the
+        stored format is checked by decoding it rather than with a TYPE lookup
+    """
+
+    def setUp(self):
+        self.previousClient = RedisStore.redisClient
+        self.client = RedisStore.redisClient = CountingRedis()
+        self.calls = 0
+
+    def tearDown(self):
+        RedisStore.redisClient = self.previousClient
+
+    def compute(self, *args):
+        self.calls += 1
+        return {'args': args}
+
+    def assertOneRoundTripPerHit(self, cached, hits=5):
+        expected = cached(1, 2)
+        self.assertEqual(self.calls, 1)
+
+        self.client.counts.reset()
+        for hit in range(hits):
+            self.assertEqual(cached(1, 2), expected)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.client.counts.roundTrips, hits)
+        self.assertNotIn('TYPE', self.client.counts.commands)
+
+    def test_object_hit(self):
+        self.assertOneRoundTripPerHit(RedisStore.cache(self.compute, RedisStore.RedisObject, cacheTime=60))
+
+    def test_string_hit(self):
+        cached = RedisStore.cache(lambda *args: str(self.compute(*args)), RedisStore.RedisString, cacheTime=60)
+        self.assertOneRoundTripPerHit(cached)
+
+    def test_stale_while_revalidate_hit(self):
+        cached = RedisStore.cache(self.compute, RedisStore.RedisObject, cacheTime=60, staleTime=60,
+                                  earlyRefreshBeta=0)
+        self.assertOneRoundTripPerHit(cached)
+
+    def test_stale_while_revalidate_iterable_hits_dont_recompute(self):
+        cached = RedisStore.cache(lambda *args: [self.compute(*args)], RedisStore.RedisList, cacheTime=600,
+                                  staleTime=600)
+        cached(1) # A missing list reads as empty, so this serves [] and computes it in the background
+        for attempt in range(100):
+            if self.calls:
+                break
+            time.sleep(.01)
+        time.sleep(.05)
+        for hit in range(5):
+            self.assertEqual(cached(1), [{'args': (1, )}])
+        time.sleep(.1) # Any refreshes run in the background
+        self.assertEqual(self.calls, 1)
+
+
+class TestLocalCache(unittest.TestCase):
+
+    def test_local_ttl_is_capped(self):
+        compute = lambda: 1
+        for cacheTime in (RedisStore.FOREVER_CACHE_TIME, RedisStore.LONG_CACHE_TIME):
+            cached = RedisStore.cache(compute, RedisStore.RedisObject, cacheTime, localCacheSize=10)
+            self.assertEqual(cached.localCache.ttl, RedisStore.LOCAL_CACHE_TTL)
+
+        cached = RedisStore.cache(compute, RedisStore.RedisObject, 5, localCacheSize=10)
+        self.assertEqual(cached.localCache.ttl, 5)
+
+
+@unittest.skipIf(CountingRedis is None, "needs fakeredis")
+class TestRedisSet(unittest.TestCase):
+
+    def test_contains_many_remembers_missing_smismember(self):
+        client = CountingRedis()
+        redisSet = RedisStore.RedisSet("set", defaultValue=set(["a", "b"]), rclient=client)
+        self.assertEqual(redisSet.contains_many(["a", "c", "b"]), [True, False, True])
+
+        client.counts.reset()
+        self.assertEqual(redisSet.contains_many(["c", "b"]), [False, True])
+        if getattr(client, 'lacksSMISMEMBER', False):
+            self.assertNotIn('SMISMEMBER', client.counts.commands)
+        self.assertEqual(client.counts.roundTrips, 1)
+
+
+
+@unittest.skipIf(CountingRedis is None, "needs fakeredis")
+class TestRedisSetExpression(unittest.TestCase):
+
+    def setUp(self):
+        self.client = CountingRedis()
+        self.sets = dict((name, RedisStore.RedisSet(name, defaultValue=members, rclient=self.client))
+                         for name, members in (("b", set(["1", "2"])), ("d", set(["1", "3"]))))
+        self.sets["a"] = RedisStore.RedisSet("a", rclient=self.client, create=False)
+
+    def test_empty_subexpression_in_intersection(self):
+        self.assertEqual(((self.sets["a"] - self.sets["b"]) & self.sets["d"]).count(), 0)
+        self.assertEqual(sorted((self.sets["b"] & self.sets["d"]) | (self.sets["d"] - self.sets["b"])), ["1", "3"])
+
+    def test_iterate_refreshes_and_cleans_up_its_result(self):
+        self.assertEqual(sorted((self.sets["b"] | self.sets["d"]).iterate(pageSize=1)), ["1", "2", "3"])
+        self.assertEqual(self.client.keys("*.tmp.*"), [])
+
+
+@unittest.skipIf(CountingRedis is None, "needs fakeredis")
+class TestCacheMany(unittest.TestCase):
+
+    def setUp(self):
+        self.previousClient = RedisStore.redisClient
+        RedisStore.redisClient = CountingRedis()
+
+    def tearDown(self):
+        RedisStore.redisClient = self.previousClient
+
+    def test_empty_argument_tuple(self):
+        cached = RedisStore.cache(lambda: "result", RedisStore.RedisObject, 60)
+        self.assertEqual(cached.many([()]), ["result"])
+        self.assertEqual(cached.many([()]), ["result"])
+
+    def test_bulk_func_must_return_one_result_per_argument(self):
+        cached = RedisStore.cache(lambda value: value, RedisStore.RedisObject, 60)
+        self.assertEqual(cached.many([1, (2, )], bulkFunc=lambda argsList: [args[0] for args in argsList]), [1, 2])
+        self.assertRaises(ValueError, cached.many, [3, 4], bulkFunc=lambda argsList: [3])
+
+
+class TestCodecs(unittest.TestCase):
+
+    def test_raw_values_are_not_mistaken_for_encoded_ones(self):
+        prefix = RedisStore.ENCODED_PREFIX
+        for raw in ("\x00bXYZ", "\x01pgarbage", "\x02j[]", prefix, prefix + "\x00", prefix + "\x00z"):
+            self.assertEqual(RedisStore.decodeValue(raw), raw)
+            self.assertFalse(RedisStore.isEncodedObject(raw))
+
+    def test_round_trip(self):
+        for codec in (RedisStore.PICKLE_CODEC, RedisStore.JSON_CODEC):
+            self.assertEqual(RedisStore.decodeValue(RedisStore.encodeValue({'a': [1]}, codec)), {'a': [1]})
+        looksEncoded = RedisStore.encodeValue(5)
+        self.assertEqual(RedisStore.decodeValue(RedisStore.pickleIfNeeded(looksEncoded)), looksEncoded)
+        self.assertTrue(RedisStore.isEncodedDict(RedisStore.encodeValue({}, marker=RedisStore.DICT_MARKER)))
+
+    def test_legacy_codec_is_never_compressed(self):
+        previousThreshold = RedisStore.COMPRESSION_THRESHOLD
+        RedisStore.COMPRESSION_THRESHOLD = 1
+        try:
+            value = ['x' * 1000]
+            encoded = RedisStore.encodeValue(value, RedisStore.LEGACY_PICKLE_CODEC)
+            encodedDict = RedisStore.encodeValue(value, RedisStore.LEGACY_PICKLE_CODEC, RedisStore.DICT_MARKER)
+        finally:
+            RedisStore.COMPRESSION_THRESHOLD = previousThreshold
+        # As read before the codec layer existed
+        self.assertEqual(pickle.loads(encoded[len("<pckl:>"):]), value)
+        self.assertEqual(pickle.loads(encodedDict[len("<vpckl:>"):]), value)
+        self.assertEqual(RedisStore.decodeValue(encoded), value)
+
+
+@unittest.skipIf(CountingRedis is None, "needs fakeredis")
+class TestRedisList(unittest.TestCase):
+
+    def test_pop_many_without_a_positive_count(self):
+        redisList = RedisStore.RedisList("list", defaultValue=[1, 2, 3], rclient=CountingRedis())
+        self.assertEqual(redisList.popMany(0), [])
+        self.assertEqual(redisList.popMany(-1), [])
+        self.assertEqual(redisList.popMany(2), [1, 2])
+        self.assertEqual(redisList.asList(), [3])
+
+    def test_capped_list_needs_a_positive_max_length(self):
+        self.assertRaises(ValueError, RedisStore.RedisCappedList, "capped", 0, rclient=CountingRedis())
+        self.assertRaises(ValueError, RedisStore.RedisCappedList, "capped", -1, rclient=CountingRedis())
+        capped = RedisStore.RedisCappedList("capped", 1, defaultValue=[1, 2], rclient=CountingRedis())
+        self.assertEqual(capped.asList(), [2])
+
+    def test_capped_append_returns_the_trimmed_length(self):
+        capped = RedisStore.RedisCappedList("capped", 3, rclient=CountingRedis(), create=False)
+        self.assertEqual([capped.append(value) for value in range(5)], [1, 2, 3, 3, 3])
+        self.assertEqual(capped.asList(), [2, 3, 4])
+
+
+@unittest.skipIf(CountingRedis is None, "needs fakeredis")
+class TestExpiryPolicies(unittest.TestCase):
+
+    def setUp(self):
+        self.client = CountingRedis()
+
+    def test_score_change_extends_sliding_ttl(self):
+        sortedSet = RedisStore.RedisSortedSet("sorted", rclient=self.client, create=False,
+                                              expiry=RedisStore.SlidingTTL(40))
+        self.assertEqual(sortedSet.add("a", 0), 1)
+        self.client.expire("sorted", 5)
+        self.assertEqual(sortedSet.add("a", 0), 0) # Unchanged
+        self.assertEqual(self.client.ttl("sorted"), 5)
+        self.assertEqual(sortedSet.add("a", 7), 0) # Moved, but not new
+        self.assertEqual(self.client.ttl("sorted"), 40)
+
+    def test_store_commands_keep_the_expiry(self):
+        other = RedisStore.RedisSet("other", defaultValue=set(["b", "c"]), rclient=self.client)
+        redisSet = RedisStore.RedisSet("set", defaultValue=set(["a", "b"]), rclient=self.client,
+                                       expiry=RedisStore.SlidingTTL(50))
+        for update, members in ((redisSet.update, ["a", "b", "c"]), (redisSet.intersection_update, ["b", "c"]),
+                                (redisSet.difference_update, [])):
+            self.client.expire("set", 5)
+            update(other)
+            self.assertEqual(sorted(redisSet), members)
+            if members:
+                self.assertEqual(self.client.ttl("set"), 50)
+
+        redisSet.add("a")
+        redisSet.update("other")
+        self.assertEqual(self.client.ttl("set"), 50)
+
+    def test_pop_applies_expiry_without_a_script(self):
+        redisSet = RedisStore.RedisSet("set", defaultValue=set(["a", "b"]), rclient=self.client,
+                                       expiry=RedisStore.SlidingTTL(40))
+        self.client.expire("set", 5)
+        self.client.counts.reset()
+        self.assertIn(redisSet.pop(), ("a", "b"))
+        self.assertEqual(self.client.ttl("set"), 40)
+        self.assertNotIn('EVALSHA', self.client.counts.commands)
+
+
+@unittest.skipIf(CountingRedis is None, "needs fakeredis")
+class TestRedisSortedSet(unittest.TestCase):
+
+    def setUp(self):
+        self.client = CountingRedis()
+        self.sortedSet = RedisStore.RedisSortedSet("sorted", rclient=self.client, create=False)
+
+    def test_auto_scores_continue_above_the_top_score(self):
+        self.sortedSet.add("top", 10)
+        self.assertEqual(self.sortedSet.add_many(["a", "b", "top"]), 2)
+        self.assertEqual(self.client.zrange("sorted", 0, -1, withscores=True),
+                         [("a", 11.0), ("b", 12.0), ("top", 13.0)])
+
+    def test_scored_pairs(self):
+        self.assertEqual(self.sortedSet.add_many((("a", 3), ("b", 1), ({'c': 1}, 2)), scored=True), 3)
+        self.assertEqual(self.sortedSet.all(), ["b", {'c': 1}, "a"])
+        self.assertEqual(self.sortedSet.score({'c': 1}), 2.0)
+
+    def test_values_are_added_in_chunks(self):
+        count = RedisStore.BULK_CHUNK_SIZE * 2 + 500
+        self.client.counts.reset()
+        self.assertEqual(self.sortedSet.add_many(["value %d" % index for index in xrange(count)]), count)
+        self.assertEqual(self.client.counts.commands.count('EVALSHA'), 3)
+        self.assertEqual(len(self.sortedSet), count)
+        self.assertEqual(self.sortedSet.score("value %d" % (count - 1)), count - 1)
+
+        self.assertEqual(self.sortedSet.add_many([("pair %d" % index, -index) for index in xrange(count)],
+                                                 scored=True), count)
+        self.assertEqual(len(self.sortedSet), count * 2)
+
+    def test_explicit_zero_score_is_kept(self):
+        self.sortedSet.add("a", 5)
+        self.assertEqual(self.sortedSet.add("b", 0), 1)
+        self.assertEqual(self.sortedSet.score("b"), 0.0)
+
+
+    def test_ranges_and_ranks(self):
+        self.sortedSet.add_many((("a", 1), ("b", 2), ("c", 3), ("d", 4)), scored=True)
+        self.assertEqual(self.sortedSet.rangeByScore(2, 3), ["b", "c"])
+        self.assertEqual(self.sortedSet.rangeByScore('(1', '+inf', start=1, num=2, withscores=True),
+                         [("c", 3.0), ("d", 4.0)])
+        self.assertEqual(self.sortedSet.rangeByScore(reverse=True, start=0, num=2), ["d", "c"])
+        self.assertEqual(self.sortedSet.top(2), [("d", 4.0), ("c", 3.0)])
+        self.assertEqual(self.sortedSet.top(0), [])
+        self.assertEqual(self.sortedSet.rank("b"), 1)
+        self.assertEqual(self.sortedSet.rank("b", reverse=True), 2)
+        self.assertEqual(self.sortedSet.rank("missing"), None)
+        self.assertEqual(self.sortedSet.incrementScore("a", 5), 6.0)
+        self.assertEqual(self.sortedSet.incrementScore("e"), 1.0)
+        self.assertEqual(self.sortedSet.top(1, withscores=False), ["a"])
+
+        lexical = RedisStore.RedisSortedSet("lexical", rclient=self.client, create=False)
+        lexical.add_many([(letter, 0) for letter in "abcde"], scored=True)
+        self.assertEqual(lexical.rangeByLex('[b', '(d'), ["b", "c"])
+        self.assertEqual(lexical.rangeByLex(reverse=True, start=0, num=2), ["e", "d"])
+
+@unittest.skipIf(CountingRedis is None, "needs fakeredis")
+class TestRedisTimeWindow(unittest.TestCase):
+
+    def setUp(self):
+        self.client = CountingRedis()
+        self.window = RedisStore.RedisTimeWindow("window", 60, rclient=self.client, create=False)
+
+    def test_adding_prunes_what_fell_out_of_the_window(self):
+        now = time.time()
+        self.window.add("old", now - 120)
+        self.window.add("new", now - 10)
+        self.assertEqual(self.window.all(), ["new"])
+        self.assertTrue(0 < self.client.ttl("window") <= 60)
+
+    def test_count_since_and_window(self):
+        now = time.time()
+        self.window.add_many((("a", now - 50), ("b", now - 20), ("c", now - 5)), scored=True)
+        self.assertEqual(self.window.count_since(), 3)
+        self.assertEqual(self.window.count_since(now - 30), 2)
+        self.assertEqual(self.window.window(), ["a", "b", "c"])
+        self.assertEqual(self.window.window(now - 30, now - 10), ["b"])
+
+    def test_allow_rejects_at_the_limit(self):
+        self.assertEqual([self.window.allow(3) for attempt in range(5)], [True, True, True, False, False])
+        self.assertEqual(len(self.window), 3)
+        self.assertEqual(self.window.count_since(), 3)
+
+
+@unittest.skipIf(CountingRedis is None, "needs fakeredis")
+class TestRedisDict(unittest.TestCase):
+
+    def test_iterkeys_does_not_decode_values(self):
+        client = CountingRedis()
+        redisDict = RedisStore.RedisDict("dict", defaultValue={'a': [1], 'b': {'c': 2}}, rclient=client)
+        client.hset("dict", "broken", RedisStore.ENCODED_PREFIX + RedisStore.VALUE_MARKER + "p" + "not a pickle")
+        self.assertEqual(sorted(redisDict.iterkeys(pageSize=1)), ['a', 'b', 'broken'])
+        self.assertEqual(sorted(redisDict), ['a', 'b', 'broken'])
+        self.assertEqual(dict(redisDict.iteritems(match='[ab]')), {'a': [1], 'b': {'c': 2}})
+
+    def test_bulk_reads_pops_and_defaults(self):
+        client = CountingRedis()
+        redisDict = RedisStore.RedisDict("dict", defaultValue={'a': [1], 'b': "text"}, rclient=client)
+        self.assertEqual(redisDict.get_many(['b', 'missing', 'a'], default=0), ["text", 0, [1]])
+        self.assertEqual(redisDict.get_many([]), [])
+        self.assertEqual(redisDict.pop('a'), [1])
+        self.assertEqual(redisDict.pop('a', 'gone'), 'gone')
+        self.assertEqual(redisDict.setdefault('b', "other"), "text")
+        self.assertEqual(redisDict.setdefault('c', {'d': 1}), {'d': 1})
+        self.assertEqual(redisDict.get('c'), {'d': 1})
+
+    def test_update_writes_in_chunks_in_one_round_trip(self):
+        client = CountingRedis()
+        redisDict = RedisStore.RedisDict("dict", rclient=client, create=False)
+        count = RedisStore.BULK_CHUNK_SIZE * 2 + 500
+        client.counts.reset()
+        redisDict.update(dict(("field %d" % index, index) for index in xrange(count)))
+        self.assertEqual(client.counts.roundTrips, 1)
+        self.assertEqual(client.counts.commands.count('HMSET'), 3)
+        self.assertEqual(len(redisDict), count)
+        self.assertEqual(redisDict.get("field %d" % (count - 1)), count - 1)
+
+
+@unittest.skipIf(CountingRedis is None, "needs fakeredis")
+class TestRedisNearDict(unittest.TestCase):
+
+    def setUp(self):
+        self.previousRetryInterval = RedisStore.NEAR_CACHE_RETRY_INTERVAL
+        RedisStore.NEAR_CACHE_RETRY_INTERVAL = .05 # So closing doesn't wait long for the subscriber to notice
+        self.client = CountingRedis()
+        RedisStore.RedisDict("near", defaultValue={'1': 'one', 'flag': True}, rclient=self.client)
+        self.nearDict = RedisStore.RedisNearDict("near", maxStaleness=60, rclient=self.client, create=False)
+        for attempt in range(100):
+            if self.nearDict.nearCache.subscribed:
+                break
+            time.sleep(.01)
+        self.assertTrue(self.nearDict.nearCache.subscribed)
+
+    def tearDown(self):
+        self.nearDict.close()
+        RedisStore.NEAR_CACHE_RETRY_INTERVAL = self.previousRetryInterval
+        self.assertFalse(self.nearDict.nearCache.thread.is_alive())
+
+    def test_handles_share_one_subscriber(self):
+        handles = [RedisStore.RedisNearDict("near", rclient=self.client, create=False) for index in range(10)]
+        self.assertTrue(all(handle.nearCache is self.nearDict.nearCache for handle in handles))
+
+    def test_reads_come_from_the_mirror(self):
+        self.assertEqual(self.nearDict['flag'], True)
+        self.client.counts.reset()
+        self.assertEqual(self.nearDict[1], 'one')
+        self.assertEqual(self.nearDict.get(1), 'one')
+        self.assertEqual(self.nearDict.get_many([1, 2], 'missing'), ['one', 'missing'])
+        self.assertTrue(self.nearDict.has_key(1))
+        self.assertEqual(self.client.counts.roundTrips, 0)
+
+    def test_writes_invalidate_the_mirror(self):
+        self.assertEqual(self.nearDict['flag'], True)
+        RedisStore.RedisNearDict("near", rclient=self.client, create=False)['flag'] = False
+        self.assertEqual(self.nearDict['flag'], False)
+
+    def test_closing_one_handle_restarts_the_mirror_for_the_others(self):
+        other = RedisStore.RedisNearDict("near", maxStaleness=60, rclient=self.client, create=False)
+        closed = other.nearCache
+        other.close()
+        self.assertFalse(closed.thread.is_alive())
+        self.assertEqual(self.nearDict['flag'], True) # From redis while the new subscriber connects
+        self.assertIsNot(self.nearDict.nearCache, closed)
+        for attempt in range(100):
+            if self.nearDict.nearCache.subscribed:
+                break
+            time.sleep(.01)
+        self.assertEqual(self.nearDict['flag'], True)
+        self.client.counts.reset()
+        self.assertEqual(self.nearDict[1], 'one')
+        self.assertEqual(self.client.counts.roundTrips, 0)
+
+if __name__ == '__main__':
+    unittest.main()